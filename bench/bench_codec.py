@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+import json
+import time
+
+from bench_utils import ns_per_call, peak_bytes_per_call, blocks_per_call
+from sample_frames import RX_FRAMES
+
+import json_codec
+from messages import JsonMsg, UDPHandShake, HandShake, Ack, Authorize
+from messages_rx import PayloadMsg, parse_json
+
+
+def tx_cases():
+    now = time.time()
+    authorize = Authorize(uniqueId=1761830827953, userId=1, chargeBoxSN="X", purpose="Start", current=8, connectorId=2)
+    return {
+            "JsonMsg.encode_raw": (JsonMsg().encode_raw, json.loads(authorize.encode())),
+            "UDPHandShake.encode": (UDPHandShake(timeout_time_unix=now, chargeBoxSN="X", ip_address="192.168.0.1", port=12345).encode,),
+            "HandShake.encode": (HandShake(current_time_unix=now, userId=1, chargeBoxSN="X", connectionKey="X").encode,),
+            "Ack.encode": (Ack(chargeBoxSN="X", uniqueId=3238).encode,),
+            "HandShake.template.fill": (HandShake.template(userId=1, chargeBoxSN="X", connectionKey="X").fill, f"{int(now * 1000)}", HandShake.format_time(now)),
+            "Ack.template.fill": (Ack.template(chargeBoxSN="X").fill, "3238"),
+            "Authorize.encode": (authorize.encode,),
+        }
+
+
+def rx_cases():
+    cases = {}
+    for action, frame in RX_FRAMES.items():
+        msg_json = json.loads(frame)
+        cases[f"loads+parse_json {action}"] = (lambda frame: parse_json(json_codec.loads(frame)), frame.encode("utf-8"))
+        cases[f"parse_json {action}"] = (parse_json, msg_json)
+        cases[f"{action}()"] = (PayloadMsg.action_registry[action], msg_json["payload"])
+    return cases
+
+
+if __name__ == "__main__":
+    print(f"JSON codec: {json_codec.codec.name}")
+    print(f"{'case':<36}{'ns/call':>10}{'peak B/call':>13}{'blocks/call':>13}")
+    for name, (f, *args) in {**tx_cases(), **rx_cases()}.items():
+        print(f"{name:<36}{ns_per_call(f, *args):>10.0f}{peak_bytes_per_call(f, *args):>13}{blocks_per_call(f, *args):>13}")
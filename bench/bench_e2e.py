@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+from bench_utils import percentile
+
+import json_codec
+
+from scharge_server import SChargeFleet
+from mqtt_client import MQTTClient
+from charger_simulator import VirtualCharger
+
+
+class RxStamper:
+    """Stands in for the ProtocolRecorder of the fleet to timestamp every received frame.
+
+    Each frame is paired with the first publish of the batch that publishes it. ChargerState publishes its updates in batches
+    taken one after another, and a frame is applied to the state as soon as it is received, so a batch covers all the frames
+    stamped before it is taken.
+    """
+
+    def __init__(self, max_frames: int = 1000):
+        self.num_frames = 0
+        # serial number -> (sequence number, time) of the frames not published yet, only for the watched chargers
+        self.pending = dict()
+        self.num_stamped = dict()
+        # serial number -> sequence number of the last frame covered by the batch being published
+        self.covered = dict()
+        # the last received frames, replayed to measure the allocations
+        self.frames = collections.deque(maxlen=max_frames)
+
+    def record(self, direction, charge_box_serial, frame):
+        if direction != "rx":
+            return
+        self.num_frames += 1
+        pending = self.pending.get(charge_box_serial)
+        if pending is not None:
+            self.num_stamped[charge_box_serial] += 1
+            pending.append((self.num_stamped[charge_box_serial], time.perf_counter()))
+            self.frames.append((charge_box_serial, frame))
+
+    def watch(self, charger_state):
+        """Starts stamping the frames of a charger, call once its MQTT client registered its update callbacks."""
+        sn = charger_state.chargeBoxSN
+        self.pending[sn] = collections.deque()
+        self.num_stamped[sn] = 0
+        self.covered[sn] = 0
+
+        def mark_batch(cbk):
+            def marked():
+                # the flush task calls the callbacks of a batch right after taking it
+                self.covered[sn] = self.num_stamped[sn]
+                return cbk()
+            return marked
+
+        charger_state.cbks_on_update[:] = [mark_batch(cbk) for cbk in charger_state.cbks_on_update]
+        for param in charger_state.all_params():
+            if param.cbk_on_update is not None:
+                param.cbk_on_update = mark_batch(param.cbk_on_update)
+
+    def published(self, charge_box_serial: str, now: float):
+        """Returns the latencies of the frames published by a publish of the charger at time now."""
+        pending = self.pending.get(charge_box_serial)
+        if not pending:
+            return []
+        covered = self.covered[charge_box_serial]
+        latencies = []
+        while pending and pending[0][0] <= covered:
+            latencies.append(now - pending.popleft()[1])
+        return latencies
+
+
+class FakeMQTTBroker:
+    """Collects the publishes of all the MQTT clients and the latency from receiving a frame to publishing its data."""
+
+    class Client:
+
+        def __init__(self, broker, charge_box_serial: str):
+            self.broker = broker
+            self.charge_box_serial = charge_box_serial
+            self.messages = self.no_messages()
+
+        async def no_messages(self):
+            await asyncio.Future()
+            yield
+
+        async def subscribe(self, topic):
+            pass
+
+        async def publish(self, topic, payload=None, **kwargs):
+            self.broker.on_publish(self.charge_box_serial)
+
+    def __init__(self, stamper: RxStamper):
+        self.stamper = stamper
+        self.num_published = 0
+        self.latencies = []
+
+    def client(self, charge_box_serial: str):
+        return FakeMQTTBroker.Client(self, charge_box_serial)
+
+    def on_publish(self, charge_box_serial: str):
+        self.num_published += 1
+        self.latencies.extend(self.stamper.published(charge_box_serial, time.perf_counter()))
+
+
+class NoWebSocket:
+    """Swallows the acks of the replayed frames."""
+
+    async def send(self, message):
+        pass
+
+
+async def alloc_bytes_per_frame(fleet: SChargeFleet, frames) -> float:
+    """Returns the mean peak memory allocated by processing a received frame until its data is published, in bytes.
+
+    The frames are replayed one by one once the simulator stopped, the peak is measured with tracemalloc like in bench_codec.py.
+    """
+    websocket = NoWebSocket()
+    total = 0
+    tracemalloc.start()
+    try:
+        for charge_box_serial, frame in frames:
+            conn = fleet.conns[charge_box_serial]
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            await conn.process_message(websocket, json_codec.loads(frame))
+            while conn.charger_state.flush_task is not None:
+                await conn.charger_state.flush_task
+            _, peak = tracemalloc.get_traced_memory()
+            total += peak - baseline
+    finally:
+        tracemalloc.stop()
+    return total / max(len(frames), 1)
+
+
+def run_simulator(address: str, serials: list[str], frame_period_s: float):
+    logger = logging.getLogger("SCharge_simulator")
+    chargers = [VirtualCharger(serial, frame_period_s, logger) for serial in serials]
+
+    async def run():
+        await asyncio.gather(*(charger.run(address) for charger in chargers))
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_scenario(num_chargers: int, frame_period_s: float, warmup_s: float, duration_s: float):
+    logger = logging.getLogger("SCharge_bench")
+    logger.setLevel(logging.WARNING)
+    serials = [f"SIM{it:06d}" for it in range(num_chargers)]
+
+    stamper = RxStamper()
+    broker = FakeMQTTBroker(stamper)
+    fleet = SChargeFleet.from_serials(serials, "127.0.0.1", None, logger=logger, recorder=stamper)
+    tasks = [asyncio.create_task(fleet.main())]
+    for conn in fleet.conns.values():
+        mqtt_client = MQTTClient("localhost", "1883", "", "", conn, logger)
+        tasks.append(asyncio.create_task(mqtt_client.run(broker.client(conn.charge_box_serial))))
+
+    while fleet.rcv_port is None:
+        await asyncio.sleep(0.01)
+
+    # the simulator runs in its own process, so that its CPU time isn't measured
+    simulator = multiprocessing.Process(target=run_simulator, args=(f"127.0.0.1:{fleet.rcv_port}", serials, frame_period_s), daemon=True)
+    simulator.start()
+    try:
+        for conn in fleet.conns.values():
+            await conn.charger_state.ready.wait()
+        await asyncio.sleep(warmup_s)
+        for conn in fleet.conns.values():
+            stamper.watch(conn.charger_state)
+
+        num_frames_start = stamper.num_frames
+        num_published_start = broker.num_published
+        broker.latencies.clear()
+        cpu_start = time.process_time()
+        t_start = time.perf_counter()
+
+        await asyncio.sleep(duration_s)
+
+        elapsed = time.perf_counter() - t_start
+        cpu = time.process_time() - cpu_start
+        num_frames = stamper.num_frames - num_frames_start
+        num_published = broker.num_published - num_published_start
+        latencies = sorted(broker.latencies)
+
+        simulator.terminate()
+        simulator.join()
+        alloc_bytes = await alloc_bytes_per_frame(fleet, list(stamper.frames))
+
+    finally:
+        simulator.terminate()
+        simulator.join()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return {
+            "chargers": num_chargers,
+            "frame_period_s": frame_period_s,
+            "frames": num_frames,
+            "frames_per_s": num_frames / elapsed,
+            "publishes_per_s": num_published / elapsed,
+            "latency_p50_ms": 1e3 * percentile(latencies, 0.50),
+            "latency_p99_ms": 1e3 * percentile(latencies, 0.99),
+            "cpu_us_per_frame": 1e6 * cpu / max(num_frames, 1),
+            "cpu_load": cpu / elapsed,
+            "alloc_bytes_per_frame": alloc_bytes,
+            "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+
+def compare(results, baseline, tolerance):
+    """Prints the scenarios that got worse than the baseline by more than tolerance and returns their number."""
+    baseline = {(res["chargers"], res["frame_period_s"]): res for res in baseline}
+    num_regressions = 0
+    for res in results:
+        base = baseline.get((res["chargers"], res["frame_period_s"]))
+        if base is None:
+            continue
+        for key in ("latency_p50_ms", "latency_p99_ms", "cpu_us_per_frame", "alloc_bytes_per_frame"):
+            # older results may miss some of the keys
+            if key in base and res[key] > base[key] * (1.0 + tolerance):
+                num_regressions += 1
+                print(f"REGRESSION {res['chargers']} chargers @ {res['frame_period_s']}s: {key} {base[key]:.3f} -> {res[key]:.3f}")
+    return num_regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark from receiving a WebSocket frame to publishing it over MQTT.")
+    parser.add_argument("--chargers", type=int, nargs="+", default=[1, 10, 100], help="numbers of simulated chargers")
+    parser.add_argument("--frame-periods", type=float, nargs="+", default=[1.0, 0.3], help="periods of the simulated data frames in seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="warm-up duration in seconds")
+    parser.add_argument("--duration", type=float, default=10.0, help="measurement duration in seconds")
+    parser.add_argument("--output", default="bench_e2e_results.json", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative worsening against the baseline reported as a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = []
+    for num_chargers in args.chargers:
+        for frame_period_s in args.frame_periods:
+            res = asyncio.run(run_scenario(num_chargers, frame_period_s, args.warmup, args.duration))
+            print(f"{num_chargers:>4} chargers @ {frame_period_s}s: {res['frames_per_s']:8.1f} frames/s, "
+                  f"p50 {res['latency_p50_ms']:6.2f}ms, p99 {res['latency_p99_ms']:6.2f}ms, "
+                  f"{res['cpu_us_per_frame']:7.1f}us CPU/frame, {res['alloc_bytes_per_frame']:8.0f}B allocated/frame")
+            results.append(res)
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}.")
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.tolerance) > 0:
+            exit(1)
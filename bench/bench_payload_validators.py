@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+import json
+from copy import deepcopy
+
+from bench_utils import ns_per_call
+from sample_frames import RX_FRAMES
+
+from messages_rx import PayloadMsg
+
+
+# the original recursive implementation, kept here as the baseline
+def legacy_parse_template(payload, payload_template):
+    payload_data = deepcopy(payload_template)
+    for key in payload_template:
+        if key not in payload:
+            raise ValueError(f"Failed to parse expected key {key} from payload {payload} (does not exist)!")
+
+        val = payload[key]
+
+        if type(val) in (int, float, str, bool):
+            if not type(val) == payload_template[key]:
+                raise ValueError(f"Failed to parse expected key {key} from payload {payload} (wrong type {type(val)}, expected {payload_template[key]})!")
+            payload_data[key] = payload[key]
+
+        else:
+            payload_data[key] = legacy_parse_template(val, payload_template[key])
+    return payload_data
+
+
+if __name__ == "__main__":
+    print(f"{'message':<15}{'legacy [ns]':>14}{'compiled [ns]':>16}{'speedup':>10}")
+    for action, frame in RX_FRAMES.items():
+        Class = PayloadMsg.action_registry[action]
+        payload = json.loads(frame)["payload"]
+        assert Class.extract_payload(payload) == legacy_parse_template(payload, Class.payload_template)
+
+        t_legacy = ns_per_call(legacy_parse_template, payload, Class.payload_template)
+        t_compiled = ns_per_call(Class, payload)
+        print(f"{action:<15}{t_legacy:>14.0f}{t_compiled:>16.0f}{t_legacy / t_compiled:>9.1f}x")
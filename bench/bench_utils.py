@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+
+# the sources are flat scripts importing each other by module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+def ns_per_call(f, *args, number: int = 20000, repeat: int = 5):
+    """Returns the best of `repeat` runs of the mean time of calling f(*args) in nanoseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        t_start = time.perf_counter_ns()
+        for _ in range(number):
+            f(*args)
+        best = min(best, (time.perf_counter_ns() - t_start) / number)
+    return best
+
+
+def percentile(sorted_values, q: float):
+    """Returns the q-quantile (0 to 1) of already sorted values, NaN if there are none."""
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def peak_bytes_per_call(f, *args):
+    """Returns the peak memory allocated while calling f(*args) once, in bytes."""
+    import tracemalloc
+    f(*args)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        f(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - baseline
+
+
+def blocks_per_call(f, *args):
+    """Returns the number of memory blocks allocated by calling f(*args) once and still held by its result."""
+    import tracemalloc
+    f(*args)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = f(*args)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+    # the snapshots allocate memory too
+    exclude = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(exclude).compare_to(before.filter_traces(exclude), "filename")
+    return sum(max(stat.count_diff, 0) for stat in stats)
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# Sample frames as sent by a JNT-EVCD2-EU charger, taken from the comments in src/messages.py and src/messages_rx.py
+
+DEVICE_DATA = '{"messageTypeId":"5","uniqueId":"3718","action":"DeviceData","payload":{"chargeBoxSN":"X","connectorMain":{"miniCurrent":6,"maxCurrent":32,"connectorStatus":0,"lockStatus":false,"PncStatus":true},"connectorVice":{"miniCurrent":6,"maxCurrent":32,"connectorStatus":0,"lockStatus":false,"PncStatus":true},"sVersion":"E3P3_H_1.1.1_R5190","hVersion":"E3P3_V1.00","loadbalance":10000,"chargeTimes":26,"cumulativeTime":71584018,"totalPower":20403,"rssi":-55,"evseType":"EU","connectorNumber":2,"evsePhase":"threephase","isHasLock":true,"isHasMeter":true}}'
+SYNCHRO_STATUS = '{"messageTypeId":"5","uniqueId":"3719","action":"SynchroStatus","payload":{"chargeBoxSN":"X","connectorMain":{"connectionStatus":false,"chargeStatus":"idle","statusCode":0,"startTime":"-","endTime":"-","reserveCurrent":0},"connectorVice":{"connectionStatus":false,"chargeStatus":"idle","statusCode":0,"startTime":"-","endTime":"-","reserveCurrent":0}}}'
+SYNCHRO_DATA = '{"messageTypeId":"5","uniqueId":"3720","action":"SynchroData","payload":{"chargeBoxSN":"X","connectorMain":{"voltage":"405.92","current":"0.00","power":"0.00","electricWork":"0.00","chargingTime":"0:0:0"},"connectorVice":{"voltage":"406.63","current":"0.00","power":"0.00","electricWork":"0.00","chargingTime":"0:0:0"},"meterInfo":{"voltage":"0.00","current":"0.00","power":"0.00"}}}'
+NWIRE_TO_DICS = '{"messageTypeId":"5","uniqueId":"3721","action":"NWireToDics","payload":{"chargeBoxSN":"X","NWireExist":true,"NWireClosed":false}}'
+
+RX_FRAMES = {
+        "DeviceData": DEVICE_DATA,
+        "SynchroStatus": SYNCHRO_STATUS,
+        "SynchroData": SYNCHRO_DATA,
+        "NWireToDics": NWIRE_TO_DICS,
+    }
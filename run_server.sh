@@ -11,6 +11,9 @@ MQTT_USER=$(bashio::services mqtt "username")
 MQTT_PASSWORD=$(bashio::services mqtt "password")
 MQTT_SERVER="$MQTT_USER@$MQTT_HOST:1883"
 
+# /data survives the add-on restarts and updates
+export SCHARGE_ENERGY_FILE=/data/scharge-energy.json
+
 source ./scharge_venv/bin/activate
 ./mqtt_client.py "$CHARGER_SERIAL" "$IP_ADDRESS" "$PORT" "$MQTT_SERVER" "$MQTT_PASSWORD"
 # ./scharge_server.py "$CHARGER_SERIAL" "$IP_ADDRESS"
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+import asyncio
+import json_codec
+import logging
+import math
+import socket
+import sys
+import time
+
+import websockets
+
+from charger_state import ChargeStatusEnum
+
+
+class VirtualCharger:
+    """Simulates one S-Charge charger connecting to the WebSocket server advertised by a UDPHandShake."""
+
+    class Connector:
+
+        def __init__(self, name: str):
+            self.name = name
+            self.connected = True
+            self.status = ChargeStatusEnum.IDLE
+            self.current = 0.0
+            self.voltage = 400.0
+            self.electric_work = 0.0
+            self.start_time = "-"
+            self.end_time = "-"
+            self.charging_start_t = None
+
+        def power(self):
+            # three phase, the voltage is the line-to-line one
+            return math.sqrt(3) * self.voltage * self.current / 1000.0
+
+        def charging_time(self):
+            if self.charging_start_t is None:
+                return "0:0:0"
+            seconds = int(time.monotonic() - self.charging_start_t)
+            return f"{seconds // 3600}:{seconds // 60 % 60}:{seconds % 60}"
+
+    def __init__(self, charge_box_serial: str, frame_period_s: float, logger: logging.Logger, min_current: int = 6, max_current: int = 32):
+        self.charge_box_serial = charge_box_serial
+        self.frame_period_s = frame_period_s
+        self.logger = logger
+        self.min_current = min_current
+        self.max_current = max_current
+
+        self.connectors = [VirtualCharger.Connector("connectorMain"), VirtualCharger.Connector("connectorVice")]
+        self.websocket = None
+        self.unique_id = 0
+        self.num_sent = 0
+        self.num_authorized = 0
+
+    def next_unique_id(self):
+        self.unique_id += 1
+        return f"{self.unique_id}"
+
+    def encode_payload_msg(self, action: str, payload: dict):
+        payload = {"chargeBoxSN": self.charge_box_serial, **payload}
+        return json_codec.dumps({"messageTypeId": "5", "uniqueId": self.next_unique_id(), "action": action, "payload": payload})
+
+    def device_data(self):
+        connector_data = {"miniCurrent": self.min_current, "maxCurrent": self.max_current, "connectorStatus": 0, "lockStatus": False, "PncStatus": True}
+        return self.encode_payload_msg("DeviceData", {
+                    "connectorMain": connector_data,
+                    "connectorVice": connector_data,
+                    "sVersion": "E3P3_H_1.1.1_R5190",
+                    "hVersion": "E3P3_V1.00",
+                    "loadbalance": 10000,
+                    "chargeTimes": 26,
+                    "cumulativeTime": 71584018,
+                    "totalPower": int(100 * sum(conn.electric_work for conn in self.connectors)),
+                    "rssi": -55,
+                    "evseType": "EU",
+                    "connectorNumber": len(self.connectors),
+                    "evsePhase": "threephase",
+                    "isHasLock": True,
+                    "isHasMeter": True
+                })
+
+    def synchro_status(self):
+        payload = {}
+        for conn in self.connectors:
+            payload[conn.name] = {
+                    "connectionStatus": conn.connected,
+                    "chargeStatus": conn.status.value,
+                    "statusCode": 0,
+                    "startTime": conn.start_time,
+                    "endTime": conn.end_time,
+                    "reserveCurrent": 0
+                }
+        return self.encode_payload_msg("SynchroStatus", payload)
+
+    def synchro_data(self):
+        payload = {}
+        for conn in self.connectors:
+            payload[conn.name] = {
+                    "voltage": f"{conn.voltage:.2f}",
+                    "current": f"{conn.current:.2f}",
+                    "power": f"{conn.power():.2f}",
+                    "electricWork": f"{conn.electric_work:.2f}",
+                    "chargingTime": conn.charging_time()
+                }
+        payload["meterInfo"] = {"voltage": "0.00", "current": "0.00", "power": "0.00"}
+        return self.encode_payload_msg("SynchroData", payload)
+
+    def nwire_to_dics(self):
+        return self.encode_payload_msg("NWireToDics", {"NWireExist": True, "NWireClosed": False})
+
+    def ack(self, uniqueId: str, result: bool):
+        return json_codec.dumps({"messageTypeId": "6", "uniqueId": uniqueId, "payload": {"chargeBoxSN": self.charge_box_serial, "result": result}})
+
+    def authorize(self, payload: dict) -> bool:
+        connector_idx = payload["connectorId"] - 1
+        if connector_idx < 0 or connector_idx >= len(self.connectors):
+            return False
+        conn = self.connectors[connector_idx]
+        self.num_authorized += 1
+
+        if payload["purpose"] == "Start":
+            if not self.min_current <= payload["current"] <= self.max_current:
+                return False
+            if conn.status != ChargeStatusEnum.CHARGING:
+                conn.status = ChargeStatusEnum.CHARGING
+                conn.electric_work = 0.0
+                conn.charging_start_t = time.monotonic()
+                conn.start_time = time.strftime("%Y-%m-%d %H:%M:%S")
+                conn.end_time = "-"
+            conn.current = float(payload["current"])
+        else:
+            if conn.status == ChargeStatusEnum.CHARGING:
+                conn.status = ChargeStatusEnum.FINISH
+                conn.end_time = time.strftime("%Y-%m-%d %H:%M:%S")
+            conn.current = 0.0
+        return True
+
+    def step(self, dt: float):
+        for conn in self.connectors:
+            conn.electric_work += conn.power() * dt / 3600.0
+            # the status goes back to idle one period after finishing
+            if conn.status == ChargeStatusEnum.FINISH and conn.current == 0.0:
+                conn.status = ChargeStatusEnum.IDLE
+                conn.charging_start_t = None
+
+    async def send(self, message: str):
+        self.num_sent += 1
+        await self.websocket.send(message)
+
+    async def stream_loop(self):
+        await self.send(self.device_data())
+        await self.send(self.nwire_to_dics())
+        it = 0
+        t_last = time.monotonic()
+        while True:
+            await self.send(self.synchro_status())
+            await self.send(self.synchro_data())
+            it += 1
+            # the totals in DeviceData change slowly, the real charger sends it rarely too
+            if it % 100 == 0:
+                await self.send(self.device_data())
+            await asyncio.sleep(self.frame_period_s)
+            now = time.monotonic()
+            self.step(now - t_last)
+            t_last = now
+
+    async def rx_loop(self):
+        async for message in self.websocket:
+            msg_json = json_codec.loads(message)
+            # the acks sent by the server and its handshakes need no answer
+            if msg_json["messageTypeId"] != "5" or msg_json["action"] != "Authorize":
+                continue
+            result = self.authorize(msg_json["payload"])
+            await self.send(self.ack(msg_json["uniqueId"], result))
+
+            # report the changed state right away like the real charger
+            if result:
+                await self.send(self.synchro_status())
+                await self.send(self.synchro_data())
+
+    async def run(self, address: str):
+        """Connects to the WebSocket server at address ("ip:port") and streams the simulated data until disconnected."""
+        async with websockets.connect(f"ws://{address}", ping_timeout=None) as websocket:
+            self.websocket = websocket
+            self.logger.info(f"Virtual charger SN{self.charge_box_serial} connected to {address}.")
+            stream_task = asyncio.create_task(self.stream_loop())
+            try:
+                await self.rx_loop()
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            finally:
+                stream_task.cancel()
+                self.websocket = None
+                self.logger.info(f"Virtual charger SN{self.charge_box_serial} disconnected.")
+
+
+class ChargerSimulator(asyncio.DatagramProtocol):
+    """Runs many VirtualChargers, each one connects back to the address advertised by the UDPHandShake for its serial number."""
+
+    def __init__(self, chargers: list[VirtualCharger], logger: logging.Logger, listen_ip: str = "0.0.0.0", listen_port: int = 3050):
+        self.chargers = {charger.charge_box_serial: charger for charger in chargers}
+        self.logger = logger
+        self.listen_ip = listen_ip
+        self.listen_port = listen_port
+        self.tasks = dict()
+
+    def datagram_received(self, data, addr):
+        try:
+            msg_json = json_codec.loads(data)
+            if msg_json["action"] != "UDPHandShake":
+                return
+            charge_box_serial = msg_json["payload"]["chargeBoxSN"]
+            address = msg_json["payload"]["iPAddress"]
+        except (ValueError, KeyError, TypeError):
+            return
+
+        charger = self.chargers.get(charge_box_serial)
+        if charger is None or charge_box_serial in self.tasks:
+            return
+        task = asyncio.create_task(self.run_charger(charger, address))
+        self.tasks[charge_box_serial] = task
+
+    async def run_charger(self, charger: VirtualCharger, address: str):
+        try:
+            await charger.run(address)
+        except OSError as e:
+            self.logger.warning(f"Virtual charger SN{charger.charge_box_serial} failed to connect to {address}: {e}")
+        finally:
+            del self.tasks[charger.charge_box_serial]
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # allows running next to the server on the same machine, the server sends its broadcasts from port 3050 too
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.listen_ip, self.listen_port))
+        transport, _ = await loop.create_datagram_endpoint(lambda: self, sock=sock)
+        self.logger.info(f"Simulating {len(self.chargers)} charger(s), listening for UDP handshakes on {self.listen_ip}:{self.listen_port}.")
+        try:
+            await asyncio.Future()
+        finally:
+            transport.close()
+            for task in self.tasks.values():
+                task.cancel()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Please specify the number of simulated chargers and optionally the period of the data frames in seconds and the UDP port to listen on!")
+        print("example:")
+        print("python3 charger_simulator.py 100 0.3 3050")
+        exit(1)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger("SCharge_simulator")
+
+    num_chargers = int(sys.argv[1])
+    frame_period_s = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    listen_port = int(sys.argv[3]) if len(sys.argv) > 3 else 3050
+
+    chargers = [VirtualCharger(f"SIM{it:06d}", frame_period_s, logger) for it in range(num_chargers)]
+    print("Simulated serial numbers: " + ",".join(charger.charge_box_serial for charger in chargers))
+    simulator = ChargerSimulator(chargers, logger, listen_port=listen_port)
+    try:
+        asyncio.run(simulator.main())
+    except KeyboardInterrupt:
+        logger.info("Interrupted by user.")
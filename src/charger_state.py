@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 from messages_rx import *
 from typing import Type, Callable
+import asyncio
+import logging
+import time
 from enum import StrEnum
 
 from mqtt_managers import *
+from time_series import TimeSeries
+from profiling import profiler
 
 
 class ChargeStatusEnum(StrEnum):
@@ -14,7 +19,11 @@ class ChargeStatusEnum(StrEnum):
 
 
 class ChargerParam:
-    def __init__(self, human_name : str, value_type: Type, parse_message_type : Type[PayloadMsg], parse_json_key : str, ha_topic : str, unit : str = "", device_class: str | None = None, state_class: str = "measurement", is_sensor: bool = True, transform : Callable = lambda x : x):
+    # the value is republished at least this often even if it didn't change,
+    # so that Home Assistant doesn't expire the entities (they use expire_after=10)
+    republish_period_s = 5.0
+
+    def __init__(self, human_name : str, value_type: Type, parse_message_type : Type[PayloadMsg], parse_json_key : str, ha_topic : str, unit : str = "", device_class: str | None = None, state_class: str = "measurement", is_sensor: bool = True, transform : Callable = lambda x : x, deadband_abs : float = 0.0, deadband_rel : float = 0.0, history_capacity : int = 0, sampled : bool = False):
         self.human_name = human_name
         self.human_name_colon = self.human_name + ":"
         self.parse_message_type = parse_message_type
@@ -28,16 +37,57 @@ class ChargerParam:
         self.state_class = state_class
         self.is_sensor = is_sensor
         self.cbk_on_update = None
-
-    async def update(self, message, payload_data = None):
+        # called synchronously with the parameter and its previous value whenever the value changes
+        self.change_cbks = []
+
+        # a numeric value is only republished if it differs from the last published one
+        # by more than deadband_abs or by more than deadband_rel times the last published value
+        self.deadband_abs = deadband_abs
+        self.deadband_rel = deadband_rel
+        self.published_value = None
+        self.published_time = None
+        self.num_published = 0
+        self.num_suppressed = 0
+
+        # the last history_capacity samples of a numeric value are kept in memory for the rolling statistics
+        self.history = TimeSeries(history_capacity) if history_capacity > 0 else None
+        # the values of the parameters with a history or explicitly sampled are passed to the sample sinks of ChargerState
+        self.sampled = sampled or self.history is not None
+
+    def changed(self):
+        if self.published_value is None or self.value is None:
+            return self.value is not self.published_value
+        if type(self.value) == float:
+            deadband = max(self.deadband_abs, self.deadband_rel * abs(self.published_value))
+            if deadband > 0.0:
+                return abs(self.value - self.published_value) > deadband
+        return self.value != self.published_value
+
+    def update(self, message, dirty, payload_data = None):
+        """Updates the value from the message and appends this parameter to dirty if it should be published."""
         if type(message) == self.parse_message_type:
+            previous = self.value
             if payload_data is None:
                 self.value = self.transform(self.value_type(message.payload_data[self.parse_json_key]))
             else:
                 self.value = self.transform(self.value_type(payload_data[self.parse_json_key]))
 
+            now = time.monotonic()
+            if self.history is not None:
+                self.history.append(now, self.value)
+
+            if self.change_cbks and self.value != previous:
+                for cbk in self.change_cbks:
+                    cbk(self, previous)
+
             if self.cbk_on_update is not None:
-                await self.cbk_on_update()
+                if self.changed() or now - self.published_time > self.republish_period_s:
+                    self.published_value = self.value
+                    self.published_time = now
+                    self.num_published += 1
+                    dirty.append(self)
+                else:
+                    self.num_suppressed += 1
 
     def __format__(self, format_spec):
         return f"{self.human_name_colon:{format_spec}}{self.value}{self.unit}"
@@ -48,6 +98,9 @@ class ChargerParam:
     def get(self):
         return self.value
 
+    def register_change_cbk(self, f_cbk):
+        self.change_cbks.append(f_cbk)
+
     def register_mqtt_mgrs(self, f_publish, f_initialized):
         if self.device_class is not None:
             if self.value_type == int or self.value_type == float:
@@ -108,6 +161,9 @@ class ChargerParam:
 
 class ChargerState:
 
+    # the SynchroData messages come every second or so, this keeps about 15 minutes of the numeric values
+    history_capacity = 900
+
     class Connector:
 
         def __init__(self, connectorName, connector_human_name):
@@ -216,7 +272,9 @@ class ChargerState:
                     unit="V",
                     parse_message_type=SynchroData,
                     parse_json_key="voltage",
-                    ha_topic=f"{self.connectorName}/charge_voltage"
+                    ha_topic=f"{self.connectorName}/charge_voltage",
+                    deadband_abs=1.0,
+                    history_capacity=ChargerState.history_capacity
                     )
             self.current = ChargerParam(
                     f"{self.connector_human_name} Current",
@@ -225,7 +283,10 @@ class ChargerState:
                     unit="A",
                     parse_message_type=SynchroData,
                     parse_json_key="current",
-                    ha_topic=f"{self.connectorName}/charge_current")
+                    ha_topic=f"{self.connectorName}/charge_current",
+                    deadband_abs=0.1,
+                    history_capacity=ChargerState.history_capacity
+                    )
             self.power = ChargerParam(
                     f"{self.connector_human_name} Power",
                     value_type=float,
@@ -233,7 +294,9 @@ class ChargerState:
                     unit="kW",
                     parse_message_type=SynchroData,
                     parse_json_key="power",
-                    ha_topic=f"{self.connectorName}/charge_power"
+                    ha_topic=f"{self.connectorName}/charge_power",
+                    deadband_abs=0.05,
+                    history_capacity=ChargerState.history_capacity
                     )
             self.electricWork = ChargerParam(
                     f"{self.connector_human_name} Charged Energy",
@@ -243,7 +306,8 @@ class ChargerState:
                     unit="kWh",
                     parse_message_type=SynchroData,
                     parse_json_key="electricWork",
-                    ha_topic=f"{self.connectorName}/charge_energy"
+                    ha_topic=f"{self.connectorName}/charge_energy",
+                    history_capacity=ChargerState.history_capacity
                     )
             self.chargingTime = ChargerParam(
                     f"{self.connector_human_name} Charging Duration",
@@ -272,17 +336,43 @@ class ChargerState:
                             self.chargingTime,
                           ]
 
+            # futures waiting until the connector state satisfies a predicate, see wait_for()
+            self.waiters = []
+
         def __format__(self, format_spec):
             ret = f"{self.connectorName}:\n"
             for param in self.params:
                 ret += f"{param:{format_spec}}\n"
             return ret
 
-        async def update(self, message):
+        def update(self, message, dirty):
             if type(message) == DeviceData or type(message) == SynchroStatus or type(message) == SynchroData:
                 connector_data = message.payload_data[self.connectorName]
                 for param in self.params:
-                    await param.update(message, connector_data)
+                    param.update(message, dirty, connector_data)
+                if self.waiters:
+                    self.notify_waiters()
+
+        def wait_for(self, predicate: Callable) -> asyncio.Future:
+            """Returns a future that is resolved as soon as predicate(connector) is true after an update (or right away)."""
+            future = asyncio.get_running_loop().create_future()
+            if predicate(self):
+                future.set_result(True)
+            else:
+                self.waiters.append((predicate, future))
+            return future
+
+        def notify_waiters(self):
+            waiters = []
+            for predicate, future in self.waiters:
+                # the future was cancelled by the waiting side
+                if future.done():
+                    continue
+                if predicate(self):
+                    future.set_result(True)
+                else:
+                    waiters.append((predicate, future))
+            self.waiters = waiters
 
         def initialized(self):
             return all(x.initialized() for x in self.params)
@@ -310,6 +400,7 @@ class ChargerState:
                     parse_message_type=SynchroData,
                     parse_json_key="voltage",
                     ha_topic=f"voltage",
+                    deadband_abs=1.0,
                     )
             self.current = ChargerParam(
                     "current",
@@ -318,6 +409,7 @@ class ChargerState:
                     parse_message_type=SynchroData,
                     parse_json_key="current",
                     ha_topic=f"current",
+                    deadband_abs=0.1,
                     )
             self.power = ChargerParam(
                     "power",
@@ -326,6 +418,7 @@ class ChargerState:
                     parse_message_type=SynchroData,
                     parse_json_key="power",
                     ha_topic=f"power",
+                    deadband_abs=0.05,
                     )
 
             self.params = [
@@ -340,11 +433,11 @@ class ChargerState:
                 ret += f"{param:{format_spec}}\n"
             return ret
 
-        async def update(self, message):
+        def update(self, message, dirty):
             if type(message) == SynchroData:
                 meterInfo_data = message.payload_data["meterInfo"]
                 for param in self.params:
-                    await param.update(message, meterInfo_data)
+                    param.update(message, dirty, meterInfo_data)
 
         def initialized(self):
             return all(x.initialized() for x in self.params)
@@ -355,8 +448,9 @@ class ChargerState:
                 ret += param.register_mqtt_mgrs(f_publish=f_publish, f_initialized=f_initialized)
             return ret
 
-    def __init__(self, chargeBoxSN):
+    def __init__(self, chargeBoxSN, logger: logging.Logger | None = None):
         self.chargeBoxSN = chargeBoxSN
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
 
         self.connectorMain = ChargerState.Connector("connectorMain", "C1")
         self.connectorVice = ChargerState.Connector("connectorVice", "C2")
@@ -384,7 +478,8 @@ class ChargerState:
                 parse_message_type=DeviceData,
                 parse_json_key="totalPower",
                 ha_topic="total_power",
-                transform=lambda x : x / 100.0
+                transform=lambda x : x / 100.0,
+                sampled=True
                 )
         self.rssi = ChargerParam(
                 "connection RSSI",
@@ -395,6 +490,7 @@ class ChargerState:
                 parse_json_key="rssi",
                 is_sensor=False,
                 ha_topic="connection_rssi",
+                history_capacity=ChargerState.history_capacity,
                 )
         self.evseType = ChargerParam("EVSE type", value_type=str, parse_message_type=DeviceData, parse_json_key="evseType", ha_topic="evse_type")
         self.evsePhase = ChargerParam("EVSE number of phases", value_type=str, parse_message_type=DeviceData, parse_json_key="evsePhase", ha_topic="evse_number_of_phases")
@@ -431,6 +527,16 @@ class ChargerState:
                 ]
 
         self.cbks_on_update = []
+        # sinks called with the serial number, the Unix time and the (ha_topic, value) pairs of the sampled parameters updated by a message
+        self.sample_sinks = []
+
+        # set once the DeviceData parameters (versions, current limits...) are known and once all parameters are known
+        self.device_info_ready = asyncio.Event()
+        self.ready = asyncio.Event()
+
+        # publish callbacks waiting for the flush task, used as an ordered set
+        self.pending_cbks = {}
+        self.flush_task = None
 
     def __str__(self):
         initialized_txt =  "not initialized"
@@ -441,19 +547,87 @@ class ChargerState:
             ret += f"{param:<31}\n"
         return ret
 
+    @profiler.profiled("ChargerState.update")
     async def update(self, message):
         # ignore data for other chargers
         if self.chargeBoxSN != message.payload_data["chargeBoxSN"]:
             return
 
+        # apply the whole frame first, then publish everything it changed in one batch
+        dirty = []
         for param in self.params:
-            await param.update(message)
+            param.update(message, dirty)
+
+        if not self.ready.is_set():
+            self.update_readiness()
+
+        if self.sample_sinks:
+            message_type = type(message)
+            samples = [(param.ha_topic, param.value) for param in self.sampled_params() if param.parse_message_type == message_type]
+            if samples:
+                now = time.time()
+                for sink in self.sample_sinks:
+                    sink(self.chargeBoxSN, now, samples)
 
+        for param in dirty:
+            self.pending_cbks[param.cbk_on_update] = None
         for cbk in self.cbks_on_update:
-            await cbk()
+            self.pending_cbks[cbk] = None
+
+        # the publishing runs in the background, so that reading the next frame doesn't wait for the MQTT broker,
+        # callbacks queued while a batch is being published are coalesced into the next batch
+        if self.pending_cbks and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        try:
+            while self.pending_cbks:
+                cbks = self.pending_cbks
+                self.pending_cbks = {}
+                results = await asyncio.gather(*(cbk() for cbk in cbks), return_exceptions=True)
+                for res in results:
+                    if isinstance(res, Exception):
+                        self.logger.error(f"Failed to publish charger state update: {res!r}")
+        finally:
+            self.flush_task = None
+
+    def update_readiness(self):
+        if not self.device_info_ready.is_set():
+            if all(x.initialized() for x in self.all_params() if x.parse_message_type == DeviceData):
+                self.device_info_ready.set()
+        if all(x.initialized() for x in self.params):
+            self.ready.set()
 
     def initialized(self):
-        return all(x.initialized() for x in self.params)
+        return self.ready.is_set()
+
+    def all_params(self):
+        for param in self.params:
+            if isinstance(param, ChargerParam):
+                yield param
+            else:
+                yield from param.params
+
+    def publish_stats(self):
+        """Returns the total number of published and suppressed (unchanged) parameter updates."""
+        num_published = 0
+        num_suppressed = 0
+        for param in self.all_params():
+            num_published += param.num_published
+            num_suppressed += param.num_suppressed
+        return num_published, num_suppressed
+
+    def history_params(self):
+        """Yields the parameters that keep a history of their values."""
+        for param in self.all_params():
+            if param.history is not None:
+                yield param
+
+    def sampled_params(self):
+        """Yields the parameters whose values are passed to the sample sinks."""
+        for param in self.all_params():
+            if param.sampled:
+                yield param
 
     def is_charging(self):
         return any(conn.is_charging() for conn in self.connectors)
@@ -473,6 +647,9 @@ class ChargerState:
     def register_update_cbk(self, f_cbk):
         self.cbks_on_update.append(f_cbk)
 
+    def register_sample_sink(self, f_sink):
+        self.sample_sinks.append(f_sink)
+
     def register_mqtt_mgrs(self, f_publish):
         ret: list[MQTTParamMgr] = []
         for param in self.params:
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+import time
+
+from metrics import Counter, Histogram
+from time_series import TimeSeries
+
+
+command_stage_latency = Histogram("scharge_command_stage_seconds", "Latency of the command stages per charger and connector.", ["sn", "connector", "stage"])
+command_stage_timeouts = Counter("scharge_command_stage_timeouts", "Commands that did not reach a stage in time per charger and connector.", ["sn", "connector", "stage"])
+
+
+class CommandLatency:
+    """Latencies of the commands sent to one connector, split into stages.
+
+    "ack" is from sending an Authorize to receiving its ack, "reflected" from the last ack to the charger state reflecting the command
+    and "total" from the first Authorize of a command (including the retries) to the charger state reflecting it.
+    """
+
+    stages = ("ack", "reflected", "total")
+    history_capacity = 100
+
+    def __init__(self, charge_box_serial: str, connectorId: int):
+        self.charge_box_serial = charge_box_serial
+        self.connectorId = connectorId
+        self.history = {stage: TimeSeries(self.history_capacity) for stage in self.stages}
+        self.last = {stage: None for stage in self.stages}
+        self.timeouts = {stage: 0 for stage in self.stages}
+        self.histograms = {stage: command_stage_latency.labels(charge_box_serial, f"{connectorId}", stage) for stage in self.stages}
+        self.timeout_counters = {stage: command_stage_timeouts.labels(charge_box_serial, f"{connectorId}", stage) for stage in self.stages}
+        # perf_counter time of the last received ack
+        self.last_ack_time = None
+        # called synchronously with the stage and the latency whenever a latency is observed
+        self.observe_cbks = []
+
+    def observe(self, stage: str, latency_s: float):
+        self.history[stage].append(time.monotonic(), latency_s)
+        self.last[stage] = latency_s
+        self.histograms[stage].observe(latency_s)
+        for cbk in self.observe_cbks:
+            cbk(stage, latency_s)
+
+    def register_observe_cbk(self, f_cbk):
+        self.observe_cbks.append(f_cbk)
+
+    def timeout(self, stage: str):
+        self.timeouts[stage] += 1
+        self.timeout_counters[stage].inc()
+
+    def stats(self, window_s: float = 3600.0):
+        """Returns the number, mean and maximum of the latencies of each stage from the last window_s seconds, the last latency and the number of timeouts."""
+        ret = {}
+        for stage in self.stages:
+            window = self.history[stage].window_stats(window_s)
+            ret[stage] = {
+                    "count": window.count if window is not None else 0,
+                    "mean_s": round(window.mean, 3) if window is not None else None,
+                    "max_s": round(window.max, 3) if window is not None else None,
+                    "last_s": round(self.last[stage], 3) if self.last[stage] is not None else None,
+                    "timeouts": self.timeouts[stage],
+                }
+        return ret
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from metrics import Counter
+
+
+commands_superseded = Counter("scharge_commands_superseded", "Commands dropped or cancelled because a newer command was submitted.", ["worker"])
+
+
+class CommandWorker:
+    """Runs the commands of one connector one at a time in a background task.
+
+    Submitting a command supersedes the command waiting to run and cancels the running one,
+    so e.g. switching the charging off doesn't wait for the retries of a start that is still in progress.
+    """
+
+    def __init__(self, name: str, logger: logging.Logger):
+        self.name = name
+        self.logger = logger
+        self.pending = None
+        self.running = None
+        self.wakeup = asyncio.Event()
+        self.superseded = commands_superseded.labels(name)
+
+    def submit(self, command: Callable[[], Awaitable]):
+        """Schedules command() to run as soon as possible."""
+        if self.pending is not None:
+            self.superseded.inc()
+        self.pending = command
+        if self.running is not None and not self.running.done():
+            self.logger.info(f"Cancelling the running command of {self.name}, superseded by a newer one.")
+            self.running.cancel()
+            self.superseded.inc()
+        self.wakeup.set()
+
+    async def main(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                command = self.pending
+                self.pending = None
+                if command is None:
+                    continue
+
+                self.running = asyncio.create_task(command())
+                # unlike awaiting the task, this doesn't raise when the command gets cancelled
+                await asyncio.wait([self.running])
+                if not self.running.cancelled() and self.running.exception() is not None:
+                    self.logger.error(f"Command of {self.name} failed: {self.running.exception()!r}")
+                self.running = None
+        finally:
+            if self.running is not None:
+                self.running.cancel()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import asyncio
+import json_codec
+import logging
+import os
+import time
+
+from charger_state import ChargerState
+
+
+class ConnectorEnergy:
+    """Lifetime energy counter of one connector.
+
+    The charger meters the energy of the current session in electricWork with a 0.01 kWh resolution, the metered increments are the authoritative part of the counter.
+    Between the meter increments, the power samples are integrated with the trapezoid rule into a provisional part
+    that is consumed by the following increments and never exceeds max_provisional_kwh, so the counter never decreases.
+    """
+
+    # samples further apart than this are not integrated (e.g. after a disconnection)
+    max_gap_s = 30.0
+    max_provisional_kwh = 0.1
+
+    def __init__(self, name: str):
+        self.name = name
+        self.power_topic = f"{name}/charge_power"
+        self.work_topic = f"{name}/charge_energy"
+
+        self.metered_kwh = 0.0
+        self.provisional_kwh = 0.0
+        self.reported_kwh = 0.0
+        self.last_work = None
+        self.last_power = None
+        self.last_t = None
+
+    def sample(self, t: float, power: float, work: float | None):
+        """Adds the power (kW) and the session energy (kWh) measured at the monotonic time t."""
+        integrated = 0.0
+        if self.last_t is not None and 0.0 < t - self.last_t <= self.max_gap_s:
+            integrated = 0.5 * (self.last_power + power) * (t - self.last_t) / 3600.0
+        self.last_t = t
+        self.last_power = power
+
+        delta = 0.0
+        if work is not None:
+            if self.last_work is not None:
+                # electricWork starts from zero with every session
+                delta = work - self.last_work if work >= self.last_work else work
+            self.last_work = work
+        self.metered_kwh += delta
+        self.provisional_kwh = min(max(0.0, self.provisional_kwh + integrated - delta), self.max_provisional_kwh)
+
+    def lifetime(self) -> float:
+        self.reported_kwh = max(self.reported_kwh, self.metered_kwh + self.provisional_kwh)
+        return self.reported_kwh
+
+    def to_dict(self):
+        return {"metered_kwh": self.metered_kwh, "provisional_kwh": self.provisional_kwh, "reported_kwh": self.reported_kwh, "last_work": self.last_work}
+
+    def from_dict(self, data: dict):
+        self.metered_kwh = data["metered_kwh"]
+        self.provisional_kwh = data["provisional_kwh"]
+        self.reported_kwh = data["reported_kwh"]
+        self.last_work = data["last_work"]
+
+
+class EnergyEngine:
+    """Monotonic energy counters of a charger, persisted to a JSON file so that they survive restarts.
+
+    The total is the sum of the connector counters and of the energy seen only in the totalPower of the charger,
+    e.g. charged before the counters existed or while the server was not running.
+    totalPower is only refreshed by the rare DeviceData messages and often includes a session only after it ends,
+    so the connector energy not yet included in it is tracked as a backlog instead of being counted twice.
+    """
+
+    def __init__(self, chargeBoxSN: str, path: str | None = None, logger: logging.Logger | None = None, save_period_s: float = 60.0):
+        self.chargeBoxSN = chargeBoxSN
+        self.path = path
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.save_period_s = save_period_s
+
+        self.connectors = [ConnectorEnergy(name) for name in ("connectorMain", "connectorVice")]
+        self.unattributed_kwh = 0.0
+        self.backlog_kwh = 0.0
+        self.last_total = None
+        self.reported_total_kwh = 0.0
+        self.dirty = False
+
+        if self.path is not None and os.path.exists(self.path):
+            self.load()
+
+    def attach(self, charger_state: ChargerState):
+        charger_state.register_sample_sink(self.record)
+
+    def record(self, chargeBoxSN: str, t: float, samples):
+        values = dict(samples)
+        now = time.monotonic()
+        for connector in self.connectors:
+            power = values.get(connector.power_topic)
+            if power is not None:
+                before = connector.lifetime()
+                connector.sample(now, power, values.get(connector.work_topic))
+                self.backlog_kwh += connector.lifetime() - before
+                self.dirty = True
+
+        total = values.get("total_power")
+        if total is not None:
+            self.reconcile(total)
+            self.dirty = True
+
+    def reconcile(self, total: float):
+        if self.last_total is None:
+            self.unattributed_kwh += max(0.0, total - self.backlog_kwh)
+            self.backlog_kwh = 0.0
+        elif total >= self.last_total:
+            self.backlog_kwh -= total - self.last_total
+            if self.backlog_kwh < 0.0:
+                self.unattributed_kwh -= self.backlog_kwh
+                self.backlog_kwh = 0.0
+        else:
+            self.logger.warning(f"Total energy of charger SN{self.chargeBoxSN} decreased from {self.last_total}kWh to {total}kWh, rebasing.")
+            self.backlog_kwh = 0.0
+        self.last_total = total
+
+    def total(self) -> float:
+        total = self.unattributed_kwh + sum(connector.lifetime() for connector in self.connectors)
+        self.reported_total_kwh = max(self.reported_total_kwh, total)
+        return round(self.reported_total_kwh, 3)
+
+    def connector_total(self, connectorId: int) -> float:
+        return round(self.connectors[connectorId - 1].lifetime(), 3)
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as file:
+                data = json_codec.loads(file.read())
+            for connector in self.connectors:
+                connector.from_dict(data["connectors"][connector.name])
+            self.unattributed_kwh = data["unattributed_kwh"]
+            self.backlog_kwh = data["backlog_kwh"]
+            self.last_total = data["last_total"]
+            self.reported_total_kwh = data["reported_total_kwh"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.error(f"Failed to load the energy counters from {self.path}, starting from zero: {e!r}")
+
+    def to_dict(self):
+        return {
+                "chargeBoxSN": self.chargeBoxSN,
+                "connectors": {connector.name: connector.to_dict() for connector in self.connectors},
+                "unattributed_kwh": self.unattributed_kwh,
+                "backlog_kwh": self.backlog_kwh,
+                "last_total": self.last_total,
+                "reported_total_kwh": self.reported_total_kwh,
+            }
+
+    def write(self, data: dict):
+        # write to a temporary file first, so that a crash never leaves a truncated file behind
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(json_codec.dumps_bytes(data))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def main(self):
+        while True:
+            await asyncio.sleep(self.save_period_s)
+            if self.path is not None and self.dirty:
+                self.dirty = False
+                try:
+                    await asyncio.to_thread(self.write, self.to_dict())
+                except OSError as e:
+                    self.logger.error(f"Failed to save the energy counters to {self.path}: {e!r}")
+
+    def close(self):
+        if self.path is not None and self.dirty:
+            self.dirty = False
+            self.write(self.to_dict())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibCodec:
+    name = "json"
+
+    @staticmethod
+    def loads(data: str | bytes):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj) -> str:
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+    @staticmethod
+    def dumps_bytes(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode("utf-8")
+
+
+class OrjsonCodec:
+    name = "orjson"
+
+    @staticmethod
+    def loads(data: str | bytes):
+        return orjson.loads(data)
+
+    @staticmethod
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    @staticmethod
+    def dumps_bytes(obj) -> bytes:
+        return orjson.dumps(obj)
+
+
+# all the codecs produce compact JSON with the keys in insertion order and non-ASCII characters unescaped
+available_codecs = [StdlibCodec]
+if orjson is not None:
+    available_codecs.insert(0, OrjsonCodec)
+
+codec = available_codecs[0]
+loads = codec.loads
+dumps = codec.dumps
+dumps_bytes = codec.dumps_bytes
+
+
+def check_conformance(codec):
+    """Raises an AssertionError if the codec doesn't behave like the stdlib one on the kinds of messages used by the protocol."""
+    samples = [
+            {"messageTypeId": "5", "uniqueId": "3720", "action": "SynchroData", "payload": {"chargeBoxSN": "X", "connectorMain": {"voltage": "405.92", "current": "0.00"}}},
+            {"messageTypeId": "5", "uniqueId": "3718", "action": "DeviceData", "payload": {"chargeBoxSN": "X", "connectorMain": {"miniCurrent": 6, "lockStatus": False, "PncStatus": True}, "rssi": -55, "totalPower": 20403}},
+            {"messageTypeId": "6", "uniqueId": "3238", "payload": {"chargeBoxSN": "X", "result": True}},
+            {"dev": {"name": "SCharge", "sw": "E3P3_H_1.1.1_R5190"}, "cmps": {"scharge_x": {"min": 6, "max": 32, "step": 1, "options": ["wait", "charging"]}}, "qos": 2, "value": None},
+            {"float": 0.1, "negative": -12.5, "unicode": "Voilá", "escapes": "quote \" backslash \\ newline \n"},
+        ]
+    for sample in samples:
+        text = codec.dumps(sample)
+        assert isinstance(text, str), f"{codec.name}: dumps() returned {type(text)}"
+        assert text == StdlibCodec.dumps(sample), f"{codec.name}: dumps() output {text} differs from {StdlibCodec.dumps(sample)}"
+        data = codec.dumps_bytes(sample)
+        assert isinstance(data, bytes), f"{codec.name}: dumps_bytes() returned {type(data)}"
+        assert data == text.encode("utf-8"), f"{codec.name}: dumps_bytes() output {data} differs from dumps() output {text}"
+        assert codec.loads(text) == sample, f"{codec.name}: loads() of str {text} does not round trip"
+        assert codec.loads(data) == sample, f"{codec.name}: loads() of bytes {data} does not round trip"
+
+    for invalid in ["", "{", "{\"a\":}", b"\xff"]:
+        try:
+            codec.loads(invalid)
+        except ValueError:
+            continue
+        raise AssertionError(f"{codec.name}: loads() accepted invalid JSON {invalid!r}")
+
+
+if __name__ == "__main__":
+    for available_codec in available_codecs:
+        check_conformance(available_codec)
+        print(f"{available_codec.name}: OK")
+    print(f"Using {codec.name}.")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import logging
+import logging.handlers
+import queue
+import time
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Passes the records to the queue unformatted, the formatting happens in the QueueListener thread."""
+
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through every sample_every-th record and at most max_per_s records per second (0 for no limit)."""
+
+    def __init__(self, max_per_s: float = 0, sample_every: int = 1):
+        super().__init__()
+        self.max_per_s = max_per_s
+        self.sample_every = sample_every
+        self.num_seen = 0
+        self.num_dropped = 0
+        self.window_start = 0.0
+        self.window_count = 0
+
+    def filter(self, record):
+        self.num_seen += 1
+        if self.num_seen % self.sample_every != 0:
+            self.num_dropped += 1
+            return False
+
+        if self.max_per_s > 0:
+            now = time.monotonic()
+            if now - self.window_start >= 1.0:
+                if self.window_count > self.max_per_s:
+                    record.msg = f"({self.window_count - self.max_per_s:.0f} similar messages dropped) {record.msg}"
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            if self.window_count > self.max_per_s:
+                self.num_dropped += 1
+                return False
+
+        return True
+
+
+def setup_logger(name: str, log_file: str, traffic_max_per_s: float = 0, traffic_sample_every: int = 1):
+    """Sets up a logger writing DEBUG messages to log_file and INFO messages to stderr.
+
+    The handlers run in a background thread fed by a queue, so logging never blocks the event loop on disk writes.
+    Per-frame traffic should be logged to the "traffic" child logger, which is sampled and rate-limited.
+    Returns the logger and the QueueListener, which has to be stopped on exit to flush the queue.
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    fh = logging.FileHandler(log_file)
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(formatter)
+
+    sh = logging.StreamHandler()
+    sh.setLevel(logging.INFO)
+    sh.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(LazyQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, fh, sh, respect_handler_level=True)
+    listener.start()
+
+    logger.getChild("traffic").addFilter(RateLimitFilter(max_per_s=traffic_max_per_s, sample_every=traffic_sample_every))
+    return logger, listener
+
+
+def stop_logger(logger: logging.Logger, listener: logging.handlers.QueueListener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
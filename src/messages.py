@@ -1,18 +1,77 @@
 #!/usr/bin/env python3
-import json
+import json_codec
 from datetime import datetime
 import asyncio
+import time
 
 
 class FutureConfirmation(asyncio.Future):
     def __init__(self, uniqueId):
         super().__init__() # to initialize the Future
         self.uniqueId = uniqueId
+        # perf_counter time of receiving the ack, None if the confirmation was not resolved by an ack
+        self.ack_time = None
+
+
+class PendingConfirmations:
+    """Outstanding FutureConfirmations indexed by the uniqueId of the message awaiting the Ack."""
+
+    def __init__(self):
+        self.pending = dict()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, uniqueId: int) -> FutureConfirmation:
+        if uniqueId in self.pending:
+            raise ValueError(f"A confirmation for message {uniqueId} is already pending!")
+        confirmation = FutureConfirmation(uniqueId)
+        self.pending[uniqueId] = confirmation
+        return confirmation
+
+    def remove(self, confirmation: FutureConfirmation):
+        if self.pending.get(confirmation.uniqueId) is confirmation:
+            del self.pending[confirmation.uniqueId]
+
+    def resolve(self, uniqueId: int, result) -> bool:
+        confirmation = self.pending.get(uniqueId)
+        if confirmation is None or confirmation.done():
+            return False
+        confirmation.ack_time = time.perf_counter()
+        confirmation.set_result(result)
+        return True
+
+    def resolve_all(self, result):
+        for confirmation in self.pending.values():
+            if not confirmation.done():
+                confirmation.set_result(result)
+        self.pending.clear()
+
+
+class MsgTemplate:
+    """A message rendered once with placeholders in place of the varying string values, encoding only fills them in."""
+
+    def __init__(self, rendered: str, placeholders: list[str]):
+        self.parts = []
+        for placeholder in placeholders:
+            part, rendered = rendered.split(placeholder, 1)
+            self.parts.append(part)
+        self.parts.append(rendered)
+
+    def fill(self, *values: str) -> str:
+        # the values are inserted as they are, they must not contain characters that need escaping in JSON
+        ret = self.parts[0]
+        for value, part in zip(values, self.parts[1:]):
+            ret += value + part
+        return ret
 
 
 class JsonMsg:
     def encode_raw(self, raw_json):
-        return json.dumps(raw_json, separators=(',', ':'))
+        return json_codec.dumps(raw_json)
+
+    def encode_raw_bytes(self, raw_json):
+        return json_codec.dumps_bytes(raw_json)
 
 
 class UDPHandShake(JsonMsg):
@@ -26,9 +85,9 @@ class UDPHandShake(JsonMsg):
         self.ip_address = ip_address
         self.port = port
 
-    def encode(self):
+    def raw_json(self):
         timestamp = int(self.timeout_time_unix * 1000)
-        raw_json =  {
+        return {
                     "messageTypeId": self.messageTypeId,
                     "uniqueId": f"{timestamp}",
                     "action": self.action,
@@ -39,7 +98,12 @@ class UDPHandShake(JsonMsg):
                         "iPAddress": f"{self.ip_address}:{self.port}"
                         }
                     }
-        return super().encode_raw(raw_json)
+
+    def encode(self):
+        return super().encode_raw(self.raw_json())
+
+    def encode_bytes(self):
+        return super().encode_raw_bytes(self.raw_json())
 
 # {"messageTypeId":"5","uniqueId":"1761830821364","action":"HandShake","payload":{"userId":"1","chargeBoxSN":"x","currentTime":"2025-10-30T14:27:01Z","connectionKey":"x"}}
 class HandShake(JsonMsg):
@@ -52,13 +116,15 @@ class HandShake(JsonMsg):
         self.current_time_unix = current_time_unix
         self.connectionKey = connectionKey
 
-    def encode(self):
-        timestamp = int(self.current_time_unix * 1000)
-        dt = datetime.fromtimestamp(self.current_time_unix)
-        formatted_time = dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-        raw_json =  {
+    @staticmethod
+    def format_time(current_time_unix : float):
+        dt = datetime.fromtimestamp(current_time_unix)
+        return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def raw_json(self, uniqueId : str, formatted_time : str):
+        return {
                     "messageTypeId": self.messageTypeId,
-                    "uniqueId": f"{timestamp}",
+                    "uniqueId": uniqueId,
                     "action": self.action,
                     "payload":
                         {
@@ -68,7 +134,16 @@ class HandShake(JsonMsg):
                         "connectionKey": f"{self.connectionKey}"
                         }
                     }
-        return super().encode_raw(raw_json)
+
+    def encode(self):
+        timestamp = int(self.current_time_unix * 1000)
+        return super().encode_raw(self.raw_json(f"{timestamp}", self.format_time(self.current_time_unix)))
+
+    @classmethod
+    def template(cls, userId : int, chargeBoxSN : int, connectionKey : int) -> MsgTemplate:
+        """Pre-renders the handshake of a connection, fill it with the uniqueId (ms timestamp) and the formatted current time."""
+        msg = cls(current_time_unix=0.0, userId=userId, chargeBoxSN=chargeBoxSN, connectionKey=connectionKey)
+        return MsgTemplate(msg.encode_raw(msg.raw_json("@uniqueId@", "@currentTime@")), ["@uniqueId@", "@currentTime@"])
 
 # {"messageTypeId":"6","uniqueId":"3238","payload":{"chargeBoxSN":"X"}}
 class Ack(JsonMsg):
@@ -89,6 +164,11 @@ class Ack(JsonMsg):
                     }
         return super().encode_raw(raw_json)
 
+    @classmethod
+    def template(cls, chargeBoxSN : int) -> MsgTemplate:
+        """Pre-renders the acks sent to one charger, fill it with the uniqueId of the acknowledged message."""
+        return MsgTemplate(cls(chargeBoxSN=chargeBoxSN, uniqueId="@uniqueId@").encode(), ["@uniqueId@"])
+
 # {"messageTypeId":"5","uniqueId":"1761830827953","action":"Authorize","payload":{"userId":"1","chargeBoxSN":"x","purpose":"Start","current":8,"connectorId":2}}
 class Authorize(JsonMsg):
     messageTypeId = "5"
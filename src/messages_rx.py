@@ -1,12 +1,54 @@
 #!/usr/bin/env python3
-from copy import deepcopy
+
+def compile_template(payload_template):
+    """Generates a function that extracts the data described by payload_template from a payload.
+
+    The generated function checks the types of all values and returns a fresh dict with the same layout as the template.
+    It raises KeyError, TypeError or ValueError when the payload does not match, without describing why.
+    """
+    lines = []
+    namespace = {}
+    checks = []
+
+    def gen(template, src):
+        items = []
+        for key, value_type in template.items():
+            var = f"v{len(lines)}"
+            lines.append(f"    {var} = {src}[{key!r}]")
+            if isinstance(value_type, dict):
+                items.append(f"{key!r}: {gen(value_type, var)}")
+            else:
+                type_name = f"t{len(namespace)}"
+                namespace[type_name] = value_type
+                checks.append(f"type({var}) is not {type_name}")
+                items.append(f"{key!r}: {var}")
+        return "{" + ", ".join(items) + "}"
+
+    ret = gen(payload_template, "payload")
+    src = "def extract(payload):\n" + "\n".join(lines) + "\n"
+    if checks:
+        src += f"    if {' or '.join(checks)}:\n        raise ValueError\n"
+    src += f"    return {ret}\n"
+    exec(src, namespace)
+    return namespace["extract"]
+
 
 class PayloadMsg:
     action = ""
     payload_template = {}
 
+    # filled in by the subclasses when they are defined, maps the action name to the class parsing it
+    action_registry = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.action in PayloadMsg.action_registry:
+            raise ValueError(f"Duplicate payload message action {cls.action} ({cls.__name__} and {PayloadMsg.action_registry[cls.action].__name__})!")
+        PayloadMsg.action_registry[cls.action] = cls
+        cls.extract_payload = staticmethod(compile_template(cls.payload_template))
+
     def parse_template(self, payload, payload_template):
-        payload_data = deepcopy(payload_template)
+        payload_data = {}
         for key in payload_template:
             if key not in payload:
                 raise ValueError(f"Failed to parse expected key {key} from payload {payload} (does not exist)!")
@@ -23,7 +65,11 @@ class PayloadMsg:
         return payload_data
 
     def __init__(self, payload):
-        self.payload_data = self.parse_template(payload, self.payload_template)
+        try:
+            self.payload_data = self.extract_payload(payload)
+        except (KeyError, TypeError, ValueError):
+            # the compiled extractor only detects the mismatch, the slow path describes it
+            self.payload_data = self.parse_template(payload, self.payload_template)
 
 
 # {"messageTypeId":"5","uniqueId":"3718","action":"DeviceData","payload":{"chargeBoxSN":"X","connectorMain":{"miniCurrent":6,"maxCurrent":32,"connectorStatus":0,"lockStatus":false,"PncStatus":true},"connectorVice":{"miniCurrent":6,"maxCurrent":32,"connectorStatus":0,"lockStatus":false,"PncStatus":true},"sVersion":"E3P3_H_1.1.1_R5190","hVersion":"E3P3_V1.00","loadbalance":10000,"chargeTimes":26,"cumulativeTime":71584018,"totalPower":20403,"rssi":-55,"evseType":"EU","connectorNumber":2,"evsePhase":"threephase","isHasLock":true,"isHasMeter":true}}
@@ -131,8 +177,8 @@ def parse_json(json):
         return None
 
 def parse_json_type_payload(json):
-    payload = json["payload"]
-    for Class in PayloadMsg.__subclasses__():
-        if json["action"] == Class.action:
-            return Class(payload)
-    return None
+    action = json["action"]
+    Class = PayloadMsg.action_registry.get(action)
+    if Class is None:
+        return None
+    return Class(json["payload"])
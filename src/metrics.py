@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import asyncio
+import bisect
+import logging
+import math
+import time
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    return repr(float(value))
+
+
+def format_labels(labelnames, labelvalues) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f"{name}=\"{value}\"")
+    return "{" + ",".join(pairs) + "}"
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        if any(existing.name == metric.name for existing in self.metrics):
+            raise ValueError(f"Duplicate metric {metric.name}!")
+        self.metrics.append(metric)
+
+    def exposition(self) -> str:
+        """Returns all the metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            metric.collect(lines)
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class Metric:
+    """Base of the metrics, a metric with label names holds one child per combination of label values returned by labels()."""
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry: MetricsRegistry | None = registry, **kwargs):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.kwargs = kwargs
+        self.children = dict()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *labelvalues):
+        child = self.children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"Metric {self.name} expects the labels {self.labelnames}, got {labelvalues}!")
+            child = type(self)(self.name, self.documentation, registry=None, **self.kwargs)
+            self.children[labelvalues] = child
+        return child
+
+    def collect(self, lines):
+        if self.labelnames:
+            for labelvalues, child in self.children.items():
+                child.collect_samples(lines, format_labels(self.labelnames, labelvalues))
+        else:
+            self.collect_samples(lines, "")
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry: MetricsRegistry | None = registry):
+        super().__init__(name, documentation, labelnames, registry)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def collect_samples(self, lines, labels):
+        lines.append(f"{self.name}_total{labels} {format_value(self.value)}")
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry: MetricsRegistry | None = registry):
+        super().__init__(name, documentation, labelnames, registry)
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set_function(self, f):
+        """Makes the gauge report f() when scraped instead of the set value."""
+        self.function = f
+
+    def collect_samples(self, lines, labels):
+        value = self.function() if self.function is not None else self.value
+        lines.append(f"{self.name}{labels} {format_value(value)}")
+
+
+class Histogram(Metric):
+    type = "histogram"
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry: MetricsRegistry | None = registry, buckets=default_buckets):
+        super().__init__(name, documentation, labelnames, registry, buckets=buckets)
+        self.upper_bounds = list(buckets)
+        # non-cumulative counts, the last one counts the observations above the largest bucket
+        self.counts = [0] * (len(self.upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def collect_samples(self, lines, labels):
+        # the le label is added after the other labels
+        prefix = labels[:-1] + "," if labels else "{"
+        cumulative = 0
+        for upper_bound, count in zip(self.upper_bounds + [math.inf], self.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{prefix}le=\"{format_value(upper_bound)}\"}} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {format_value(self.sum)}")
+        lines.append(f"{self.name}_count{labels} {self.count}")
+
+
+loop_lag = Histogram("scharge_event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task.")
+
+
+async def loop_lag_monitor(period_s: float = 0.5):
+    """Measures how late the event loop wakes up this task, i.e. how long the callbacks block it."""
+    while True:
+        t_start = time.perf_counter()
+        await asyncio.sleep(period_s)
+        loop_lag.observe(max(0.0, time.perf_counter() - t_start - period_s))
+
+
+async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, registry: MetricsRegistry):
+    try:
+        async with asyncio.timeout(5.0):
+            request_line = await reader.readline()
+            # the headers are not needed
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status = "200 OK"
+            body = registry.exposition().encode("utf-8")
+        else:
+            status = "404 Not Found"
+            body = b"Not found, the metrics are at /metrics\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except (TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port: int, host: str = "127.0.0.1", registry: MetricsRegistry = registry, logger: logging.Logger | None = None):
+    """Serves the metrics over HTTP at /metrics and measures the event loop lag until cancelled."""
+    logger = logger if logger is not None else logging.getLogger(__name__)
+    server = await asyncio.start_server(lambda reader, writer: handle_request(reader, writer, registry), host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics.")
+    async with server:
+        await loop_lag_monitor()
@@ -2,11 +2,22 @@
 
 import asyncio
 import aiomqtt
-import json
+import json_codec
 import ipaddress
+import logging
+import os
+import time
 
 from scharge_server import *
 from mqtt_managers import *
+from log_utils import setup_logger, stop_logger
+from telemetry_store import TelemetryStore
+from energy import EnergyEngine
+from sessions import SessionTracker
+import metrics
+from profiling import profiler
+from command_worker import CommandWorker
+import signal
 
 
 # from https://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib/
@@ -25,104 +36,232 @@ def get_ip():
     return ip
 
 
+mqtt_publishes = metrics.Counter("scharge_mqtt_publishes", "Messages published to the MQTT broker.")
+mqtt_publish_latency = metrics.Histogram("scharge_mqtt_publish_seconds", "Time taken by publishing a message to the MQTT broker.")
+
+
 class MQTTClient:
-    def __init__(self, hostname: str, port: str, username: str, password: str, scharge_conn: SChargeConn, logger: logging.Logger):
+    def __init__(self, hostname: str, port: str, username: str, password: str, scharge_conn: SChargeConn, logger: logging.Logger, energy_file: str | None = None):
         self.hostname = hostname
         self.port = int(port)
         self.username = username
         self.password = password
         self.scharge_conn = scharge_conn
         self.logger = logger
+        self.traffic_logger = logger.getChild("traffic")
+        self.client = None
         self.topic_mgrs = list()
+        # command topic -> manager processing it
+        self.command_handlers = dict()
+        # command topic -> function returning the connector ID of commands that are run by the connector's CommandWorker
+        self.connector_commands = dict()
+        self.command_workers = [CommandWorker(f"connector {connectorId}", logger) for connectorId in range(1, len(scharge_conn.charger_state.connectors) + 1)]
+        # a single retained availability for all the entities, set to offline by the broker if the connection drops
+        self.availability_topic = "scharge/availability"
+        self.published_availability = None
+        self.profiling_mqtt_mgr = None
 
         self.desired_current = 0
+        self.stats_period_s = 60.0
+
+        # the energy counters are attached right away, so that no samples are missed before the MQTT connection
+        self.energy = EnergyEngine(scharge_conn.charge_box_serial, path=energy_file, logger=logger)
+        self.energy.attach(scharge_conn.charger_state)
+        self.sessions = SessionTracker(scharge_conn.charge_box_serial, logger=logger)
+        self.sessions.attach(scharge_conn.charger_state)
+        self.sessions.register_session_cbk(self.publish_session)
+        self.scharge_conn.register_connection_cbk(self.connection_changed)
 
     async def main(self):
         self.logger.info(f"Starting MQTT client with hostname {self.hostname}:{self.port}, user: {self.username}, password: {self.password}.")
-        async with aiomqtt.Client(hostname=self.hostname, port=self.port, username=self.username, password=self.password) as client:
-            self.client = client
-            # TODO: fix using Futures
-            while not self.scharge_conn.charger_state.initialized():
-                await asyncio.sleep(1)
-            discovery_topic = f"homeassistant/device/scharge{self.scharge_conn.charge_box_serial}/config"
-
-            charging_mqtt_mgr = MQTTSwitchMgr(
-                        name="charging",
-                        human_name="Charging",
-                        process_msg=self.process_switch_charging,
+        will = aiomqtt.Will(self.availability_topic, "offline", qos=1, retain=True)
+        async with aiomqtt.Client(hostname=self.hostname, port=self.port, username=self.username, password=self.password, will=will) as client:
+            try:
+                await self.run(client)
+            finally:
+                # the broker only sends the will if the connection drops, not on a clean disconnect
+                try:
+                    await client.publish(self.availability_topic, "offline", qos=1, retain=True, timeout=5.0)
+                except aiomqtt.MqttError as e:
+                    self.logger.warning(f"Failed to publish the offline availability: {e!r}")
+
+    async def run(self, client: aiomqtt.Client):
+        """Publishes the charger to Home Assistant over an already connected client and processes the incoming commands."""
+        self.client = client
+        # the discovery only needs the device info, the entity states need the full charger state
+        await self.scharge_conn.charger_state.device_info_ready.wait()
+        discovery_topic = f"homeassistant/device/scharge{self.scharge_conn.charge_box_serial}/config"
+
+        charging_mqtt_mgr = MQTTSwitchMgr(
+                    name="charging",
+                    human_name="Charging",
+                    process_msg=self.process_switch_charging,
+                    publish=self.publish,
+                    get_state=self.scharge_conn.charger_state.is_charging,
+                    get_available=self.scharge_conn.charger_state.initialized
+                    )
+        self.scharge_conn.charger_state.register_update_cbk(charging_mqtt_mgr.publish_state_if_changed)
+        self.topic_mgrs.append(charging_mqtt_mgr)
+        # starting and stopping can take many retries, they run in the background
+        self.connector_commands[charging_mqtt_mgr.command_topic] = self.charging_connector_id
+
+        set_current_mqtt_mgr = MQTTNumberMgr(
+                    name="set_current",
+                    human_name="Set Current",
+                    minimum=self.scharge_conn.charger_state.connectorMain.miniCurrent.value,
+                    maximum=self.scharge_conn.charger_state.connectorMain.maxCurrent.value,
+                    step=1,
+                    process_msg=self.process_set_current,
+                    publish=self.publish,
+                    get_state=lambda: self.desired_current,
+                    get_available=self.scharge_conn.charger_state.initialized
+                    )
+        self.scharge_conn.charger_state.register_update_cbk(set_current_mqtt_mgr.publish_state_if_changed)
+        self.topic_mgrs.append(set_current_mqtt_mgr)
+
+        set_energy_mqtt_mgr = MQTTSensorMgr(
+                    name="total_energy_calc",
+                    human_name="Total Energy Charged",
+                    device_class="energy",
+                    state_class="total_increasing",
+                    unit="kWh",
+                    publish=self.publish,
+                    get_state=self.get_total_charged_energy,
+                    get_available=self.scharge_conn.charger_state.initialized
+                    )
+        self.scharge_conn.charger_state.register_update_cbk(set_energy_mqtt_mgr.publish_state_if_changed)
+        self.topic_mgrs.append(set_energy_mqtt_mgr)
+
+        for connectorId, connector in enumerate(self.scharge_conn.charger_state.connectors, start=1):
+            command_latency_mqtt_mgr = MQTTNumberDiagMgr(
+                        name=f"{connector.connectorName}/command_latency",
+                        human_name=f"{connector.connector_human_name} Command Latency",
+                        device_class="duration",
+                        unit="s",
                         publish=self.publish,
-                        get_state=self.scharge_conn.charger_state.is_charging,
+                        get_state=lambda connectorId=connectorId: self.get_command_latency(connectorId),
                         get_available=self.scharge_conn.charger_state.initialized
                         )
-            self.scharge_conn.charger_state.register_update_cbk(charging_mqtt_mgr.publish_state)
-            self.topic_mgrs.append(charging_mqtt_mgr)
-
-            set_current_mqtt_mgr = MQTTNumberMgr(
-                        name="set_current",
-                        human_name="Set Current",
-                        minimum=self.scharge_conn.charger_state.connectorMain.miniCurrent.value,
-                        maximum=self.scharge_conn.charger_state.connectorMain.maxCurrent.value,
-                        step=1,
-                        process_msg=self.process_set_current,
-                        publish=self.publish,
-                        get_state=lambda: self.desired_current,
-                        get_available=self.scharge_conn.charger_state.initialized
-                        )
-            self.scharge_conn.charger_state.register_update_cbk(set_current_mqtt_mgr.publish_state)
-            self.topic_mgrs.append(set_current_mqtt_mgr)
-
-            set_energy_mqtt_mgr = MQTTSensorMgr(
-                        name="total_energy_calc",
-                        human_name="Total Energy Charged",
+            # published when a command completes, the charger frames only keep it from expiring
+            self.scharge_conn.command_latency[connectorId - 1].register_observe_cbk(
+                    lambda stage, latency_s, mgr=command_latency_mqtt_mgr: self.command_latency_observed(mgr, stage))
+            self.scharge_conn.charger_state.register_update_cbk(command_latency_mqtt_mgr.publish_state_if_changed)
+            self.topic_mgrs.append(command_latency_mqtt_mgr)
+
+            connector_energy_mqtt_mgr = MQTTSensorMgr(
+                        name=f"{connector.connectorName}/lifetime_energy",
+                        human_name=f"{connector.connector_human_name} Lifetime Energy",
                         device_class="energy",
                         state_class="total_increasing",
                         unit="kWh",
                         publish=self.publish,
-                        get_state=self.get_total_charged_energy,
+                        get_state=lambda connectorId=connectorId: self.energy.connector_total(connectorId),
                         get_available=self.scharge_conn.charger_state.initialized
                         )
-            self.scharge_conn.charger_state.register_update_cbk(set_energy_mqtt_mgr.publish_state)
-            self.topic_mgrs.append(set_energy_mqtt_mgr)
+            # the counters change slowly, don't republish them with every frame
+            self.scharge_conn.charger_state.register_update_cbk(connector_energy_mqtt_mgr.publish_state_if_changed)
+            self.topic_mgrs.append(connector_energy_mqtt_mgr)
+
+        profiling_mqtt_mgr = MQTTSwitchMgr(
+                    name="profiling",
+                    human_name="Profiling",
+                    process_msg=self.process_switch_profiling,
+                    publish=self.publish,
+                    get_state=lambda: profiler.enabled,
+                    get_available=lambda: True
+                    )
+        # only changes on a command or a signal, see toggle_profiling()
+        self.profiling_mqtt_mgr = profiling_mqtt_mgr
+        self.topic_mgrs.append(profiling_mqtt_mgr)
+
+        self.topic_mgrs += self.scharge_conn.charger_state.register_mqtt_mgrs(self.publish)
+
+        self.logger.info(f"Publishing discovery message to {discovery_topic}.")
+        await self.publish(discovery_topic, self.generate_discovery_payload(self.scharge_conn))
 
-            self.topic_mgrs += self.scharge_conn.charger_state.register_mqtt_mgrs(self.publish)
-
-            msg = self.generate_discovery_payload(self.scharge_conn)
-            self.logger.info(f"Publishing discovery message to {discovery_topic}.")
-            await self.publish(discovery_topic, msg)
+        for mgr in self.topic_mgrs:
+            if mgr.command_topic is not None:
+                self.command_handlers[mgr.command_topic] = mgr
+                await client.subscribe(mgr.command_topic)
+
+        await self.scharge_conn.charger_state.ready.wait()
+        self.logger.info(f"Charger state initialized, publishing entity states.")
+        await self.publish_states()
+        await self.publish_availability()
+        asyncio.create_task(self.stats_loop())
+        asyncio.create_task(self.energy.main())
+        for worker in self.command_workers:
+            asyncio.create_task(worker.main())
+        # asyncio.create_task(self.state_loop(client))
+
+        await client.subscribe("homeassistant/status")
+        async for message in client.messages:
+            self.traffic_logger.debug("%s << %s", message.topic, message.payload)
+            if message.topic.matches("homeassistant/status"):
+                # Home Assistant restarted and forgot the discovery and the states
+                if message.payload == b"online":
+                    self.logger.info(f"Home Assistant is online, republishing the discovery message and the entity states.")
+                    await self.publish(discovery_topic, self.generate_discovery_payload(self.scharge_conn))
+                    await self.publish_states()
+                continue
+            topic = str(message.topic)
+            mgr = self.command_handlers.get(topic)
+            if mgr is None:
+                continue
+            get_connector_id = self.connector_commands.get(topic)
+            if get_connector_id is None:
+                await mgr.process_msg(mgr, message)
+            else:
+                self.command_workers[get_connector_id() - 1].submit(lambda mgr=mgr, message=message: mgr.process_msg(mgr, message))
 
-            for mgr in self.topic_mgrs:
-                if mgr.command_topic is not None:
-                    await client.subscribe(mgr.command_topic)
+    async def publish_states(self):
+        for mgr in self.topic_mgrs:
+            if mgr.availability_topic is not None:
                 await self.publish(mgr.availability_topic, mgr.get_availability_msg())
-                await self.publish(mgr.state_topic, mgr.get_state_msg())
-            asyncio.create_task(self.availability_loop())
-            # asyncio.create_task(self.state_loop(client))
-
-            await client.subscribe("homeassistant/status")
-            async for message in client.messages:
-                self.logger.debug(f"{message.topic} << {message.payload}")
-                for mgr in self.topic_mgrs:
-                    if mgr.command_topic == str(message.topic):
-                        await mgr.process_msg(mgr, message)
-
-    async def availability_loop(self):
+            await self.publish(mgr.state_topic, mgr.get_state_msg())
+
+    def is_available(self):
+        return self.scharge_conn.is_connected() and self.scharge_conn.charger_state.initialized()
+
+    async def publish_availability(self):
+        """Publishes the device availability if it changed since the last publish."""
+        availability = "online" if self.is_available() else "offline"
+        if availability != self.published_availability:
+            self.published_availability = availability
+            await self.publish(self.availability_topic, availability, retain=True, qos=1)
+
+    def connection_changed(self):
+        # the availability is published once the charger state is ready, see run()
+        if self.client is not None and self.published_availability is not None:
+            asyncio.create_task(self.publish_availability())
+
+
+    async def stats_loop(self):
         while True:
-            for mgr in self.topic_mgrs:
-                await self.publish(mgr.availability_topic, mgr.get_availability_msg())
-            await asyncio.sleep(3)
-    
+            await asyncio.sleep(self.stats_period_s)
+            num_published, num_suppressed = self.scharge_conn.charger_state.publish_stats()
+            self.logger.info(f"Parameter updates published: {num_published}, suppressed as unchanged: {num_suppressed}.")
+
+    def get_command_latency(self, connectorId: int):
+        # the time the last start or stop command took to be reflected by the charger, unknown until a command completes
+        last = self.scharge_conn.command_latency[connectorId - 1].last["total"]
+        return round(last, 3) if last is not None else None
+
+    def command_latency_observed(self, mgr: MQTTNumberDiagMgr, stage: str):
+        if stage == "total":
+            asyncio.create_task(mgr.publish_state_if_changed())
+
     def get_total_charged_energy(self):
-        total_energy = self.scharge_conn.charger_state.totalPower.value
-        for connector in self.scharge_conn.charger_state.connectors:
-            cur_charge_energy = connector.electricWork.value
-            if connector.is_charging():
-                total_energy += cur_charge_energy
-        return total_energy
+        return self.energy.total()
 
-    async def process_switch_charging(self, mgr : MQTTSwitchMgr, msg: aiomqtt.Message):
+    def charging_connector_id(self):
         connectorId = 1
         if not self.scharge_conn.charger_state.connectorMain.is_connected() and self.scharge_conn.charger_state.connectorVice.is_connected():
             connectorId = 2
+        return connectorId
+
+    async def process_switch_charging(self, mgr : MQTTSwitchMgr, msg: aiomqtt.Message):
+        connectorId = self.charging_connector_id()
 
         if msg.payload == b"ON":
             self.logger.info(f"Starting charging from MQTT on connector {connectorId} with current {self.desired_current}A!")
@@ -140,14 +279,38 @@ class MQTTClient:
                 self.logger.error(f"Failed to stop charging!")
         await self.publish(mgr.state_topic, mgr.get_state_msg())
 
+    async def process_switch_profiling(self, mgr : MQTTSwitchMgr, msg: aiomqtt.Message):
+        profiler.set(msg.payload == b"ON")
+        await self.publish(mgr.state_topic, mgr.get_state_msg())
+
+    def toggle_profiling(self):
+        profiler.toggle()
+        if self.profiling_mqtt_mgr is not None:
+            asyncio.create_task(self.profiling_mqtt_mgr.publish_state())
+
     async def process_set_current(self, mgr : MQTTSwitchMgr, msg: aiomqtt.Message):
         self.desired_current = int(msg.payload)
         self.logger.info(f"Changed desired charging current to {self.desired_current}A.")
+        # applied right away to the connectors already charging, solar-following automations change it often so it goes through the coalescer
+        for connectorId, connector in enumerate(self.scharge_conn.charger_state.connectors, start=1):
+            if connector.is_charging():
+                self.scharge_conn.set_current(self.desired_current, connectorId)
         await self.publish(mgr.state_topic, mgr.get_state_msg())
 
-    async def publish(self, topic: str, message: str):
-        self.logger.debug(f"{topic} >> {message}")
-        await self.client.publish(topic, message)
+    def publish_session(self, summary: dict):
+        if self.client is None:
+            return
+        # the summary of the last session stays available to new subscribers
+        connector = self.scharge_conn.charger_state.connectors[summary["connector"] - 1]
+        asyncio.create_task(self.publish(f"scharge/{connector.connectorName}/last_session", json_codec.dumps(summary), retain=True))
+
+    @profiler.profiled("MQTTClient.publish")
+    async def publish(self, topic: str, message: str, retain: bool = False, qos: int = 0):
+        self.traffic_logger.debug("%s >> %s", topic, message)
+        t_start = time.perf_counter()
+        await self.client.publish(topic, message, qos=qos, retain=retain)
+        mqtt_publish_latency.observe(time.perf_counter() - t_start)
+        mqtt_publishes.inc()
 
     def generate_discovery_payload(self, sconn: SChargeConn):
         chinfo = sconn.charger_state
@@ -173,6 +336,9 @@ class MQTTClient:
               {
               },
               "state_topic": "scharge/state",
+              "availability_topic": self.availability_topic,
+              "payload_available": "online",
+              "payload_not_available": "offline",
               "qos": 2
             }
 
@@ -180,7 +346,7 @@ class MQTTClient:
             cmp_name, cmp_desc = mgr.get_description()
             ret["cmps"][cmp_name] = cmp_desc
 
-        return json.dumps(ret, separators=(',', ':'))
+        return json_codec.dumps(ret)
 
 if __name__ == "__main__":
     if len(sys.argv) < 5:
@@ -189,19 +355,8 @@ if __name__ == "__main__":
         print("python3 mqtt_client XXXXYYYYZZZZ 192.168.0.1 auto mqtt_user@homeassistant.local:1883 mqtt_password")
         exit(1)
 
-    scharge_logger = logging.getLogger("SCharge_server")
-    scharge_logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    fh = logging.FileHandler("/tmp/scharge-server.log")
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
-    scharge_logger.addHandler(fh)
-
-    sh = logging.StreamHandler()
-    sh.setLevel(logging.INFO)
-    sh.setFormatter(formatter)
-    scharge_logger.addHandler(sh)
+    traffic_max_per_s = float(os.environ.get("SCHARGE_TRAFFIC_LOG_RATE", 50))
+    scharge_logger, scharge_log_listener = setup_logger("SCharge_server", "/tmp/scharge-server.log", traffic_max_per_s=traffic_max_per_s)
 
     charge_box_serial = sys.argv[1]
     rcv_ip = sys.argv[2]
@@ -216,39 +371,54 @@ if __name__ == "__main__":
     rcv_port = sys.argv[3]
     if rcv_port == "auto":
         rcv_port = None
-    scharge_conn = SChargeConn(charge_box_serial, rcv_ip=rcv_ip, rcv_port=rcv_port, logger=scharge_logger)
-
-    mqtt_logger = logging.getLogger("SCharge_mqtt")
-    mqtt_logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    recorder = None
+    if os.environ.get("SCHARGE_CAPTURE_FILE"):
+        recorder = ProtocolRecorder(os.environ["SCHARGE_CAPTURE_FILE"])
+    setpoint_min_interval_s = float(os.environ.get("SCHARGE_SETPOINT_INTERVAL", 2.0))
+    scharge_conn = SChargeConn(charge_box_serial, rcv_ip=rcv_ip, rcv_port=rcv_port, logger=scharge_logger, recorder=recorder, setpoint_min_interval_s=setpoint_min_interval_s)
 
-    fh = logging.FileHandler("/tmp/scharge-mqtt.log")
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
-    mqtt_logger.addHandler(fh)
-
-    sh = logging.StreamHandler()
-    sh.setLevel(logging.INFO)
-    sh.setFormatter(formatter)
-    mqtt_logger.addHandler(sh)
+    mqtt_logger, mqtt_log_listener = setup_logger("SCharge_mqtt", "/tmp/scharge-mqtt.log", traffic_max_per_s=traffic_max_per_s)
 
     mqtt_server_address = sys.argv[4]
     mqtt_password = sys.argv[5]
     mqtt_user = mqtt_server_address.split("@")[0]
     mqtt_hostname = mqtt_server_address.split("@")[1].split(":")[0]
     mqtt_port = mqtt_server_address.split("@")[1].split(":")[1]
-    mqtt_client = MQTTClient(mqtt_hostname, mqtt_port, mqtt_user, mqtt_password, scharge_conn, mqtt_logger)
+    energy_file = os.environ.get("SCHARGE_ENERGY_FILE", f"/tmp/scharge-energy-{charge_box_serial}.json")
+    mqtt_client = MQTTClient(mqtt_hostname, mqtt_port, mqtt_user, mqtt_password, scharge_conn, mqtt_logger, energy_file=energy_file)
+
+    profiler.logger = mqtt_logger
+    # the metrics are not authenticated, they are only served if asked for and only locally by default
+    metrics_port = int(os.environ.get("SCHARGE_METRICS_PORT", 0))
+    metrics_host = os.environ.get("SCHARGE_METRICS_HOST", "127.0.0.1")
+    pending_confirmations.set_function(scharge_conn.num_pending_confirmations)
+
+    telemetry_store = None
+    if os.environ.get("SCHARGE_TELEMETRY_DB"):
+        telemetry_store = TelemetryStore(os.environ["SCHARGE_TELEMETRY_DB"], logger=mqtt_logger)
+        telemetry_store.attach(scharge_conn.charger_state, mqtt_client.sessions)
 
     try:
         async def run_tasks():
             asyncio.create_task(scharge_conn.main())
             asyncio.create_task(mqtt_client.main())
+            if telemetry_store is not None:
+                asyncio.create_task(telemetry_store.main())
+            if metrics_port > 0:
+                asyncio.create_task(metrics.serve(metrics_port, host=metrics_host, logger=mqtt_logger))
+            # kill -USR1 <pid> switches the profiling on and off
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, mqtt_client.toggle_profiling)
             await asyncio.Future()
         asyncio.run(run_tasks())
 
     except (KeyboardInterrupt, asyncio.exceptions.CancelledError):
         mqtt_logger.info("Interrupted by user.")
 
-    for handler in mqtt_logger.handlers:
-        handler.close()
-        mqtt_logger.removeFilter(handler)
+    if recorder is not None:
+        recorder.close()
+    if telemetry_store is not None:
+        telemetry_store.close()
+    mqtt_client.energy.close()
+
+    stop_logger(mqtt_logger, mqtt_log_listener)
+    stop_logger(scharge_logger, scharge_log_listener)
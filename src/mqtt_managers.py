@@ -1,14 +1,40 @@
 #!/usr/bin/env python3
+import time
 
 from typing import Callable, List
 
 
 class MQTTParamMgr:
-    pass
+    # the entities without their own availability topic use the availability of the whole device
+    availability_topic = None
+    # see publish_state_if_changed(), the sensors use expire_after=10
+    republish_period_s = 5.0
+    published_msg = None
+    published_time = None
+
+    async def publish_state_if_changed(self):
+        """Publishes the state only if it changed since the last publish or if the last publish is older than republish_period_s."""
+        msg = self.get_state_msg()
+        now = time.monotonic()
+        if self.published_time is not None and msg == self.published_msg and now - self.published_time <= self.republish_period_s:
+            return
+        self.published_msg = msg
+        self.published_time = now
+        await self.publish(self.state_topic, msg)
+
+    def availability_description(self):
+        if self.availability_topic is None:
+            return {}
+        return {
+                "availability_topic": self.availability_topic,
+                "payload_available": "online",
+                "payload_not_available": "offline",
+                "availability_mode": "latest",
+            }
 
 
 class MQTTSwitchMgr(MQTTParamMgr):
-    def __init__(self, name: str, human_name: str, process_msg: Callable, publish: Callable, get_state: Callable, get_available: Callable):
+    def __init__(self, name: str, human_name: str, process_msg: Callable, publish: Callable, get_state: Callable, get_available: Callable, availability_topic: str | None = None):
         self.name = name
         self.human_name = human_name
         self.process_msg = process_msg
@@ -18,7 +44,7 @@ class MQTTSwitchMgr(MQTTParamMgr):
 
         self.state_topic = f"scharge/{self.name}/state"
         self.command_topic = f"scharge/{self.name}/set"
-        self.availability_topic = f"scharge/{self.name}/available"
+        self.availability_topic = availability_topic
 
     def get_state_msg(self):
         if self.get_state():
@@ -49,10 +75,7 @@ class MQTTSwitchMgr(MQTTParamMgr):
                     "command_topic": self.command_topic,
                     "payload_on": "ON",
                     "payload_off": "OFF",
-                    "availability_topic": self.availability_topic,
-                    "payload_available": "online",
-                    "payload_not_available": "offline",
-                    "availability_mode": "latest",
+                    **self.availability_description(),
                     "optimistic": True,
                     "qos": 0,
                     "retain": False,
@@ -61,7 +84,7 @@ class MQTTSwitchMgr(MQTTParamMgr):
 
 
 class MQTTNumberMgr(MQTTParamMgr):
-    def __init__(self, name: str, human_name: str, minimum: float | int, maximum: float | int, step: float | int, process_msg: Callable, publish: Callable, get_state: Callable, get_available: Callable):
+    def __init__(self, name: str, human_name: str, minimum: float | int, maximum: float | int, step: float | int, process_msg: Callable, publish: Callable, get_state: Callable, get_available: Callable, availability_topic: str | None = None):
         self.name = name
         self.human_name = human_name
         self.minimum = minimum
@@ -74,7 +97,7 @@ class MQTTNumberMgr(MQTTParamMgr):
 
         self.state_topic = f"scharge/{self.name}/state"
         self.command_topic = f"scharge/{self.name}/set"
-        self.availability_topic = f"scharge/{self.name}/available"
+        self.availability_topic = availability_topic
 
     def get_state_msg(self):
         return self.get_state()
@@ -104,10 +127,7 @@ class MQTTNumberMgr(MQTTParamMgr):
                     "step": self.step,
                     "command_topic": self.command_topic,
                     "payload_reset": "reset",
-                    "availability_topic": self.availability_topic,
-                    "payload_available": "online",
-                    "payload_not_available": "offline",
-                    "availability_mode": "latest",
+                    **self.availability_description(),
                     "optimistic": True,
                     "qos": 0,
                     "retain": True,
@@ -116,7 +136,7 @@ class MQTTNumberMgr(MQTTParamMgr):
 
 
 class MQTTNumberDiagMgr(MQTTParamMgr):
-    def __init__(self, name: str, human_name: str, device_class: str, unit: str, publish: Callable, get_state: Callable, get_available: Callable):
+    def __init__(self, name: str, human_name: str, device_class: str, unit: str, publish: Callable, get_state: Callable, get_available: Callable, availability_topic: str | None = None):
         self.name = name
         self.human_name = human_name
         self.device_class = device_class
@@ -127,13 +147,15 @@ class MQTTNumberDiagMgr(MQTTParamMgr):
 
         self.state_topic = f"scharge/{self.name}/state"
         self.command_topic = f"scharge/{self.name}/set"
-        self.availability_topic = f"scharge/{self.name}/available"
+        self.availability_topic = availability_topic
 
     async def publish_state(self):
         await self.publish(self.state_topic, self.get_state_msg())
 
     def get_state_msg(self):
-        return self.get_state()
+        state = self.get_state()
+        # Home Assistant shows "None" as unknown, an empty message would be ignored
+        return "None" if state is None else state
 
     def get_availability_msg(self):
         if self.get_available():
@@ -153,10 +175,7 @@ class MQTTNumberDiagMgr(MQTTParamMgr):
                     "unit_of_measurement": self.unit,
                     "state_topic": self.state_topic,
                     "command_topic": self.command_topic,
-                    "availability_topic": self.availability_topic,
-                    "payload_available": "online",
-                    "payload_not_available": "offline",
-                    "availability_mode": "latest",
+                    **self.availability_description(),
                     "expire_after": 10,
                     "qos": 0,
                 }
@@ -164,7 +183,7 @@ class MQTTNumberDiagMgr(MQTTParamMgr):
 
 
 class MQTTEnumSensorMgr(MQTTParamMgr):
-    def __init__(self, name: str, human_name: str, options: List[str], publish: Callable, get_state: Callable, get_available: Callable):
+    def __init__(self, name: str, human_name: str, options: List[str], publish: Callable, get_state: Callable, get_available: Callable, availability_topic: str | None = None):
         self.name = name
         self.human_name = human_name
         self.device_class = "enum"
@@ -175,7 +194,7 @@ class MQTTEnumSensorMgr(MQTTParamMgr):
 
         self.state_topic = f"scharge/{self.name}/state"
         self.command_topic = None
-        self.availability_topic = f"scharge/{self.name}/available"
+        self.availability_topic = availability_topic
 
     def get_state_msg(self):
         return self.get_state()
@@ -199,10 +218,7 @@ class MQTTEnumSensorMgr(MQTTParamMgr):
                     "device_class": self.device_class,
                     "options": self.options,
                     "state_topic": self.state_topic,
-                    "availability_topic": self.availability_topic,
-                    "payload_available": "online",
-                    "payload_not_available": "offline",
-                    "availability_mode": "latest",
+                    **self.availability_description(),
                     "expire_after": 10,
                     "qos": 0,
                 }
@@ -210,7 +226,7 @@ class MQTTEnumSensorMgr(MQTTParamMgr):
 
 
 class MQTTSensorMgr(MQTTParamMgr):
-    def __init__(self, name: str, human_name: str, device_class: str, unit: str, publish: Callable, get_state: Callable, get_available: Callable, state_class: str = "measurement"):
+    def __init__(self, name: str, human_name: str, device_class: str, unit: str, publish: Callable, get_state: Callable, get_available: Callable, state_class: str = "measurement", availability_topic: str | None = None):
         self.name = name
         self.human_name = human_name
         self.device_class = device_class
@@ -222,7 +238,7 @@ class MQTTSensorMgr(MQTTParamMgr):
 
         self.state_topic = f"scharge/{self.name}/state"
         self.command_topic = None
-        self.availability_topic = f"scharge/{self.name}/available"
+        self.availability_topic = availability_topic
 
     async def publish_state(self):
         await self.publish(self.state_topic, self.get_state_msg())
@@ -245,10 +261,7 @@ class MQTTSensorMgr(MQTTParamMgr):
                     "state_class": self.state_class,
                     "unit_of_measurement": self.unit,
                     "state_topic": self.state_topic,
-                    "availability_topic": self.availability_topic,
-                    "payload_available": "online",
-                    "payload_not_available": "offline",
-                    "availability_mode": "latest",
+                    **self.availability_description(),
                     "expire_after": 10,
                     "qos": 0,
                 }
@@ -258,7 +271,7 @@ class MQTTSensorMgr(MQTTParamMgr):
 
 
 class MQTTBinarySensorMgr(MQTTParamMgr):
-    def __init__(self, name: str, human_name: str, device_class: str, publish: Callable, get_state: Callable, get_available: Callable):
+    def __init__(self, name: str, human_name: str, device_class: str, publish: Callable, get_state: Callable, get_available: Callable, availability_topic: str | None = None):
         self.name = name
         self.human_name = human_name
         self.device_class = device_class
@@ -268,7 +281,7 @@ class MQTTBinarySensorMgr(MQTTParamMgr):
 
         self.state_topic = f"scharge/{self.name}/state"
         self.command_topic = None
-        self.availability_topic = f"scharge/{self.name}/available"
+        self.availability_topic = availability_topic
 
     async def publish_state(self):
         await self.publish(self.state_topic, self.get_state_msg())
@@ -296,10 +309,7 @@ class MQTTBinarySensorMgr(MQTTParamMgr):
                     "state_topic": self.state_topic,
                     "payload_on": "ON",
                     "payload_off": "OFF",
-                    "availability_topic": self.availability_topic,
-                    "payload_available": "online",
-                    "payload_not_available": "offline",
-                    "availability_mode": "latest",
+                    **self.availability_description(),
                     "expire_after": 10,
                     "qos": 0,
                 }
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import time
+
+
+class CallsiteStats:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+    def add(self, duration_s: float):
+        self.count += 1
+        self.total_s += duration_s
+        if duration_s > self.max_s:
+            self.max_s = duration_s
+
+
+class Timing:
+    """Context manager adding the wall time spent in its block to a CallsiteStats."""
+
+    def __init__(self, stats: CallsiteStats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.stats.add(time.perf_counter() - self.t_start)
+
+
+class NoTiming:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc, traceback):
+        pass
+
+
+no_timing = NoTiming()
+
+
+class Profiler:
+    """cProfile of the event loop thread and wall time of the instrumented call sites, switched on and off at runtime.
+
+    Switching it off writes the profile (.prof, readable by pstats or snakeviz) and a text summary to snapshot_dir.
+    While switched off, the instrumented call sites only check a flag.
+    """
+
+    def __init__(self, snapshot_dir: str = "/tmp", logger: logging.Logger | None = None):
+        self.snapshot_dir = snapshot_dir
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.enabled = False
+        self.profile = None
+        self.t_start = None
+        self.callsites = dict()
+
+    def callsite(self, name: str) -> CallsiteStats:
+        stats = self.callsites.get(name)
+        if stats is None:
+            stats = CallsiteStats(name)
+            self.callsites[name] = stats
+        return stats
+
+    def timed(self, name: str):
+        """Returns a context manager timing its block as the call site name while profiling."""
+        if not self.enabled:
+            return no_timing
+        return Timing(self.callsite(name))
+
+    def profiled(self, name: str):
+        """Decorator timing the calls of a coroutine function as the call site name while profiling."""
+        stats = self.callsite(name)
+
+        def decorator(f):
+            @functools.wraps(f)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await f(*args, **kwargs)
+                t_start = time.perf_counter()
+                try:
+                    return await f(*args, **kwargs)
+                finally:
+                    stats.add(time.perf_counter() - t_start)
+            return wrapper
+        return decorator
+
+    def start(self):
+        if self.enabled:
+            return
+        for stats in self.callsites.values():
+            stats.reset()
+        self.profile = cProfile.Profile()
+        self.t_start = time.time()
+        self.enabled = True
+        self.profile.enable()
+        self.logger.info("Profiling started.")
+
+    def stop(self):
+        """Stops profiling and writes the snapshot from a worker thread, returns the path prefix of the snapshot files."""
+        if not self.enabled:
+            return None
+        self.profile.disable()
+        self.enabled = False
+        path = f"{self.snapshot_dir}/scharge-profile-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.t_start))}"
+        callsites = [(stats.name, stats.count, stats.total_s, stats.max_s) for stats in self.callsites.values()]
+        duration_s = time.time() - self.t_start
+        # sorting the profile takes a while on a slow machine, don't block the event loop with it
+        asyncio.get_running_loop().run_in_executor(None, self.write_snapshot, path, self.profile, callsites, duration_s)
+        self.profile = None
+        return path
+
+    def toggle(self):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def set(self, enabled: bool):
+        if enabled:
+            self.start()
+        else:
+            self.stop()
+
+    def write_snapshot(self, path: str, profile: cProfile.Profile, callsites, duration_s: float):
+        try:
+            profile.dump_stats(f"{path}.prof")
+            summary = io.StringIO()
+            summary.write(f"Profiled for {duration_s:.1f}s.\n\n")
+            summary.write(f"{'call site':<32}{'calls':>10}{'total [s]':>12}{'mean [ms]':>12}{'max [ms]':>12}\n")
+            for name, count, total_s, max_s in callsites:
+                mean_ms = 1e3 * total_s / count if count > 0 else 0.0
+                summary.write(f"{name:<32}{count:>10}{total_s:>12.3f}{mean_ms:>12.3f}{1e3 * max_s:>12.3f}\n")
+            summary.write("\n")
+            pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(40)
+            with open(f"{path}.txt", "w") as file:
+                file.write(summary.getvalue())
+            self.logger.info(f"Profile written to {path}.prof and {path}.txt.")
+        except OSError as e:
+            self.logger.error(f"Failed to write the profile to {path}: {e!r}")
+
+
+profiler = Profiler()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import gzip
+import io
+import json_codec
+import os
+import queue
+import threading
+import time
+
+
+class ProtocolRecorder:
+    """Records raw protocol frames to a capture file, one JSON object per line.
+
+    Each line holds the monotonic timestamp "t", the direction "d" ("rx", "tx" or "udp"), the charger serial number "sn" and the raw frame "f".
+    The file is written by a background thread and rotated once it grows over max_bytes, keeping backup_count older files.
+    Captures whose path ends with ".gz" are gzip-compressed, max_bytes then limits the compressed size.
+    At most max_queued frames wait for the thread, the frames over that are dropped (e.g. if writing the file failed).
+    """
+
+    def __init__(self, path: str, max_bytes: int = 50_000_000, backup_count: int = 5, max_queued: int = 10_000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = path.endswith(".gz")
+        self.num_dropped = 0
+
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.thread = threading.Thread(target=self.writer_loop, name="ProtocolRecorder", daemon=True)
+        self.thread.start()
+
+    def record(self, direction: str, charge_box_serial: str | None, frame: str | bytes):
+        try:
+            self.queue.put_nowait((time.monotonic(), direction, charge_box_serial, frame))
+        except queue.Full:
+            self.num_dropped += 1
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def open(self):
+        """Returns the text file to write to and the underlying file, whose position is the size on disk."""
+        raw = open(self.path, "ab")
+        stream = gzip.GzipFile(fileobj=raw, mode="ab") if self.compress else raw
+        return io.TextIOWrapper(stream, encoding="utf-8"), raw
+
+    def rotate(self):
+        for it in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{it}"):
+                os.replace(f"{self.path}.{it}", f"{self.path}.{it + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def writer_loop(self):
+        file, raw = self.open()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                t, direction, charge_box_serial, frame = item
+                if isinstance(frame, bytes):
+                    frame = frame.decode("utf-8", errors="replace")
+                line = json_codec.dumps({"t": round(t, 6), "d": direction, "sn": charge_box_serial, "f": frame}) + "\n"
+                file.write(line)
+
+                # only flush once the queue is drained, so bursts of frames are written together
+                if self.queue.empty():
+                    file.flush()
+
+                # the compressed data only reaches the file in blocks, so a .gz capture may overshoot max_bytes by one block
+                if raw.tell() > self.max_bytes:
+                    file.close()
+                    raw.close()
+                    self.rotate()
+                    file, raw = self.open()
+        finally:
+            # closing the GzipFile doesn't close the file it was given
+            file.close()
+            raw.close()
+
+
+def read_capture(path: str):
+    """Yields the (timestamp, direction, serial number, frame) tuples stored in a capture file."""
+    # check the gzip magic number instead of the suffix, the rotated files end with a number
+    with open(path, "rb") as file:
+        compressed = file.read(2) == b"\x1f\x8b"
+    if compressed:
+        file = gzip.open(path, "rt", encoding="utf-8")
+    else:
+        file = open(path, "r", encoding="utf-8")
+    with file:
+        for line in file:
+            # a capture cut off by a crash may end with a partial line
+            try:
+                record = json_codec.loads(line)
+            except ValueError:
+                continue
+            yield record["t"], record["d"], record["sn"], record["f"]
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import json_codec
+import sys
+import time
+
+from messages_rx import parse_json
+from charger_state import ChargerState
+from protocol_recorder import read_capture
+
+
+async def replay(path: str, speed: float = 0.0, publish=None):
+    """Feeds the frames received in a capture through parse_json, ChargerState.update and the MQTT managers.
+
+    With speed 0 the frames are replayed as fast as possible, otherwise the original timing is scaled by 1/speed (1 is real time).
+    publish(topic, message) is called for every MQTT publish, by default the publishes are only counted.
+    Returns a dict with the replay statistics.
+    """
+    num_published = 0
+
+    async def count_publish(topic, message):
+        nonlocal num_published
+        num_published += 1
+
+    if publish is None:
+        publish = count_publish
+
+    charger_states = {}
+    num_frames = 0
+    num_parsed = 0
+    t_capture_start = None
+    t_start = time.perf_counter()
+
+    for t, direction, charge_box_serial, frame in read_capture(path):
+        if direction != "rx":
+            continue
+
+        if speed > 0:
+            if t_capture_start is None:
+                t_capture_start = t
+            delay = (t - t_capture_start) / speed - (time.perf_counter() - t_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        num_frames += 1
+        # the frames are recorded before they are validated, skip the malformed ones like the server does
+        try:
+            msg_json = json_codec.loads(frame)
+            msg_parsed = parse_json(msg_json)
+            msg_serial = msg_json["payload"]["chargeBoxSN"]
+            if not isinstance(msg_serial, str):
+                raise TypeError(f"chargeBoxSN is a {type(msg_serial).__name__}")
+        except (ValueError, KeyError, TypeError):
+            continue
+        if msg_parsed is None:
+            continue
+        num_parsed += 1
+
+        charger_state = charger_states.get(msg_serial)
+        if charger_state is None:
+            charger_state = ChargerState(msg_serial)
+            charger_state.register_mqtt_mgrs(publish)
+            charger_states[msg_serial] = charger_state
+        await charger_state.update(msg_parsed)
+        # update() only schedules the publishing, wait for it so that every frame goes through the MQTT managers
+        # like in the server, where reading the next frame yields to the flush task
+        while charger_state.flush_task is not None:
+            await charger_state.flush_task
+
+    duration = time.perf_counter() - t_start
+    return {
+            "frames": num_frames,
+            "parsed": num_parsed,
+            "chargers": len(charger_states),
+            "published": num_published,
+            "duration_s": duration,
+            "frames_per_s": num_frames / duration if duration > 0 else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Please specify the capture file and optionally the replay speed (0 for as fast as possible, 1 for real time)!")
+        print("example:")
+        print("python3 replay.py /tmp/scharge-capture.jsonl.gz 0")
+        exit(1)
+
+    capture_path = sys.argv[1]
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    stats = asyncio.run(replay(capture_path, speed))
+    print(json.dumps(stats, indent=2))
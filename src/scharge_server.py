@@ -1,46 +1,83 @@
 #!/usr/bin/env python3
+import signal
 import socket
 import time
 import sys
+import os
 import ipaddress
-import logging
+import math
 
 import asyncio
 import websockets
-import json
+import json_codec
 
 from messages import *
 from messages_rx import *
 from charger_state import ChargerState
+from log_utils import setup_logger, stop_logger
+from protocol_recorder import ProtocolRecorder
+from telemetry_store import TelemetryStore
+from sessions import SessionTracker
+from metrics import Counter, Gauge, Histogram
+from command_latency import CommandLatency
+from setpoint_coalescer import SetpointCoalescer
+from profiling import profiler
+
+frames_received = Counter("scharge_frames_received", "WebSocket frames received from the chargers.", ["action"])
+parse_failures = Counter("scharge_parse_failures", "Received frames that could not be parsed.", ["reason"])
+acks_sent = Counter("scharge_acks_sent", "Acks sent to the chargers.")
+authorize_rtt = Histogram("scharge_authorize_rtt_seconds", "Time from sending an Authorize command to receiving its ack per charger.", ["sn", "purpose"])
+charger_connections = Counter("scharge_charger_connections", "WebSocket connections established by the chargers.")
+charger_downtime = Histogram("scharge_charger_downtime_seconds", "Duration of the charger disconnections ended by a reconnection.", buckets=(1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0))
+pending_confirmations = Gauge("scharge_pending_confirmations", "Commands sent to the chargers waiting for their ack.")
+
 
 class SChargeConn:
 
-    def __init__(self, charge_box_serial, rcv_ip, rcv_port, logger):
-        self.shutdown = False
+    def __init__(self, charge_box_serial, rcv_ip, rcv_port, logger, recorder: ProtocolRecorder | None = None, setpoint_min_interval_s: float = 2.0):
         self.websocket = None
-        self.future_confirmations = list()
+        self.pending_confirmations = PendingConfirmations()
+        self.last_msg_id = 0
         self.logger = logger
+        # per-frame messages go to a child logger that can be sampled and rate-limited
+        self.traffic_logger = logger.getChild("traffic")
 
         self.charge_box_serial = charge_box_serial
         self.user_id = 1
         self.connection_key = charge_box_serial
 
-        self.charger_state = ChargerState(self.charge_box_serial)
+        self.charger_state = ChargerState(self.charge_box_serial, logger=self.logger)
+        self.command_latency = [CommandLatency(self.charge_box_serial, connectorId) for connectorId in range(1, len(self.charger_state.connectors) + 1)]
+        # monotonic time of the last Authorize sent to each connector
+        self.last_authorize_time = [-math.inf] * len(self.charger_state.connectors)
+
+        # the outbound messages sent periodically only differ in the id and time, render the rest once
+        self.ack_template = Ack.template(chargeBoxSN=self.charge_box_serial)
+        self.handshake_template = HandShake.template(userId=self.user_id, chargeBoxSN=self.charge_box_serial, connectionKey=self.connection_key)
 
         self.rcv_ip = rcv_ip
         self.rcv_port = rcv_port
 
-        # get the 24 subnet corresponding to the specified ip address
-        ip_network = ipaddress.ip_network(rcv_ip).supernet(new_prefix=24)
-        self.broadcast_ip = f"{ip_network.broadcast_address}"
-        self.broadcast_port = 3050
-
-        self.udp_handshake_timeout_s = 1.9
         self.confirmation_timeout_s = 5.0
+        # start/stop commands are resent after this period until the charger state reflects them, or until the timeout
+        self.command_retry_period_s = 3.0
+        self.command_timeout_s = 30.0
         self.handshake_period_s = 3.0
         self.request_data_period_s = 0.3
+        # current setpoints changed while charging are sent at most once per this period per connector
+        self.setpoint_min_interval_s = setpoint_min_interval_s
+        self.setpoints = [SetpointCoalescer(self.charge_box_serial, connectorId, lambda current, connectorId=connectorId: self.send_setpoint(current, connectorId),
+                                            lambda connectorId=connectorId: self.last_authorize_time[connectorId - 1], self.logger, self.setpoint_min_interval_s)
+                          for connectorId in range(1, len(self.charger_state.connectors) + 1)]
 
         self.loop_tasks = set()
+        self.handshake_loop_task = None
+
+        # optionally records all the raw frames to a capture file
+        self.recorder = recorder
+        self.disconnected_time = None
+        # called synchronously whenever the charger connects or disconnects
+        self.connection_cbks = []
 
     async def send_authorize_msg(self, current: int, purpose: str, connectorId: int):
         if self.websocket is None:
@@ -53,7 +90,9 @@ class SChargeConn:
         if connectorId > num_connectors or connectorId < 1:
             return False, f"invalid connector ID {connectorId} (expected within range of [1, {num_connectors}]"
 
-        msg_id = int(1000 * time.time())
+        # the ids are millisecond timestamps, bump them so that two commands sent within the same millisecond don't collide
+        msg_id = max(int(1000 * time.time()), self.last_msg_id + 1)
+        self.last_msg_id = msg_id
         msg = Authorize(
                     uniqueId = msg_id,
                     userId = self.user_id,
@@ -64,205 +103,232 @@ class SChargeConn:
                 )
         message = msg.encode()
 
-        confirmation = FutureConfirmation(msg_id)
-        self.future_confirmations.append(confirmation)
-        await self.send_message(self.websocket, message)
+        confirmation = self.pending_confirmations.add(msg_id)
+        latency = self.command_latency[connectorId - 1]
+        t_sent = time.perf_counter()
+
+        def on_ack(future):
+            # runs before the callbacks of the state frames that follow the ack
+            if future.ack_time is not None:
+                authorize_rtt.labels(self.charge_box_serial, purpose).observe(future.ack_time - t_sent)
+                latency.observe("ack", future.ack_time - t_sent)
+                latency.last_ack_time = future.ack_time
+        confirmation.add_done_callback(on_ack)
 
         try:
+            self.last_authorize_time[connectorId - 1] = time.monotonic()
+            await self.send_message(self.websocket, message)
             await asyncio.wait_for(confirmation, timeout=self.confirmation_timeout_s)
-            self.future_confirmations.remove(confirmation)
             return confirmation.result(), "response received"
 
         except TimeoutError:
             self.logger.warning(f"Timeout when awaiting confirmation for message {msg}")
-            self.future_confirmations.remove(confirmation)
+            latency.timeout("ack")
             return False, "response timed out"
 
-    async def start_charging(self, current: int, connectorId: int, current_tolerance = 1.0) -> bool:
-        connector_idx = connectorId-1
-        max_retries = 10
-
-        retries = 0
-        while self.charger_state.connectors[connector_idx].current.value is None:
-            self.logger.debug(f"Waiting for charger state intialization.")
-            retries += 1
-            if retries > max_retries:
-                return False
-            await asyncio.sleep(1.0)
-
-        while True:
-            self.logger.debug(f"Sending start charging command at {current}A.")
-            res = await self.send_authorize_msg(current, "Start", connectorId)
-            self.logger.debug(res)
-            if abs(self.charger_state.connectors[connector_idx].current.value - current) > current_tolerance:
-                retries += 1
-                self.logger.debug(f"The charge current does not match the desired ({self.charger_state.connectors[connector_idx].current} != {current}A). Tries: {retries}/{max_retries}.")
-                self.logger.debug(f"{self.charger_state.connectors[connector_idx]:<31}")
-                if retries > max_retries:
-                    return False
-                await asyncio.sleep(3.0)
-            else:
-                break
+        finally:
+            self.pending_confirmations.remove(confirmation)
 
-        return True
+    async def send_setpoint(self, current: int, connectorId: int):
+        # a setpoint still queued when the charging stops must not start it again
+        if not self.charger_state.connectors[connectorId-1].is_charging():
+            return False, "not charging"
+        return await self.send_authorize_msg(current, "Start", connectorId)
 
-    async def stop_charging(self, connectorId: int) -> bool:
-        connector_idx = connectorId-1
-        max_retries = 5
-
-        retries = 0
-        while self.charger_state.connectors[connector_idx].current.value is None:
-            self.logger.debug(f"Waiting for charger state intialization.")
-            retries += 1
-            if retries > max_retries:
-                return False
-            await asyncio.sleep(1.0)
-
-        retries = 0
-        while True:
-            self.logger.debug(f"Sending stop charging command.")
-            res = await self.send_authorize_msg(self.charger_state.connectors[connector_idx].miniCurrent.value, "Stop", connectorId)
-            self.logger.debug(res)
-            if self.charger_state.connectors[connector_idx].is_charging():
-                retries += 1
-                self.logger.debug(f"The charge status ({self.charger_state.connectors[connector_idx].chargeStatus}) does not match the desired. Tries: {retries}/{max_retries}.")
-                self.logger.debug(f"{self.charger_state.connectors[connector_idx]:<31}")
-                if retries > max_retries:
-                    return False
-                await asyncio.sleep(3.0)
-            else:
-                break
+    def set_current(self, current: int, connectorId: int):
+        """Changes the current of a charging connector, rate-limited and keeping only the latest of the setpoints changed in quick succession."""
+        self.setpoints[connectorId-1].submit(current)
 
-        return True
+    def num_pending_confirmations(self):
+        return len(self.pending_confirmations)
 
-    async def send_message(self, websocket, message):
-        self.logger.debug(f">> {message}")
-        await websocket.send(message)
+    def command_latency_stats(self, connectorId: int, window_s: float = 3600.0):
+        """Returns the latencies of the command stages of a connector, see CommandLatency.stats()."""
+        return self.command_latency[connectorId - 1].stats(window_s)
 
-    async def send_ack(self, websocket, uniqueId):
-        msg = Ack(
-                    chargeBoxSN = self.charge_box_serial,
-                    uniqueId = int(uniqueId)
-                )
-        message = msg.encode()
-        await self.send_message(websocket, message)
+    def trace_command(self, connectorId: int, reflected: asyncio.Future):
+        """Measures the latency of a command from now until the reflected future resolves."""
+        latency = self.command_latency[connectorId - 1]
+        t_start = time.perf_counter()
 
-    async def process_websocket(self, websocket):
-        """Handles messages from the connected charger."""
+        def on_reflected(future):
+            if future.cancelled():
+                return
+            t_reflected = time.perf_counter()
+            latency.observe("total", t_reflected - t_start)
+            if latency.last_ack_time is not None and latency.last_ack_time >= t_start:
+                # with retries, measured from the ack of the last attempt
+                latency.observe("reflected", max(0.0, t_reflected - latency.last_ack_time))
+
+        # nothing to measure if the state already matches
+        if not reflected.done():
+            reflected.add_done_callback(on_reflected)
+        return latency
+
+    async def start_charging(self, current: int, connectorId: int, current_tolerance = 1.0, timeout_s: float | None = None) -> bool:
+        connector = self.charger_state.connectors[connectorId-1]
+        if timeout_s is None:
+            timeout_s = self.command_timeout_s
+
+        self.setpoints[connectorId-1].cancel()
+        current_reached = connector.wait_for(lambda conn: conn.current.value is not None and abs(conn.current.value - current) <= current_tolerance)
+        latency = self.trace_command(connectorId, current_reached)
         try:
-            if self.websocket is None:
-                self.websocket = websocket
-                self.connected_ws_evt.set()
-                remote_ip, remote_port = websocket.remote_address
-                self.logger.info(f"Connection established with {remote_ip}:{remote_port}!")
-
-            async for message in websocket:
-                self.logger.debug(f"<< {message}")
-                msg_json = json.loads(message)
-
-                msg_serial = msg_json["payload"]["chargeBoxSN"]
-                if msg_serial != self.charge_box_serial:
-                    self.logger.info("Ignoring message for a different charge box with SN{msg_serial} (expected SN{self.charge_box_serial}).")
-                    continue
-
-                # If it's an Ack message check if we're not expecting confirmation for a message
-                if msg_json["messageTypeId"] == Ack.messageTypeId:
-                    for future_confirmation in self.future_confirmations:
-                        if future_confirmation.uniqueId == int(msg_json["uniqueId"]):
-                            future_confirmation.set_result(msg_json["payload"]["result"])
-
-                # Otherwise it's a payload message, sned an ack for it and then process it
-                else:
-                    # print("Got message, sending ack")
-                    asyncio.create_task(self.send_ack(websocket, msg_json["uniqueId"]))
-
-                    msg_parsed = parse_json(msg_json)
-                    if msg_parsed is not None:
-                        await self.charger_state.update(msg_parsed)
-                        # print(f"{self.charger_state}")
-        except (websockets.exceptions.ConnectionClosedError, ConnectionResetError) as e:
-            self.logger.info(f"Websocket server disconnected: {e}")
-            self.disconnected_evt.set()
+            async with asyncio.timeout(timeout_s):
+                self.logger.debug(f"Waiting for charger state intialization.")
+                await self.charger_state.ready.wait()
+
+                retries = 0
+                while True:
+                    self.logger.debug(f"Sending start charging command at {current}A.")
+                    res = await self.send_authorize_msg(current, "Start", connectorId)
+                    self.logger.debug(res)
+                    try:
+                        await asyncio.wait_for(asyncio.shield(current_reached), timeout=self.command_retry_period_s)
+                        break
+                    except TimeoutError:
+                        retries += 1
+                        self.logger.debug(f"The charge current does not match the desired ({connector.current} != {current}A). Tries: {retries}.")
+                        self.logger.debug(f"{connector:<31}")
 
-    async def server_loop(self):
-        self.disconnected_evt = asyncio.Event()
-        self.logger.info(f"Starting WebSocket server on {self.rcv_ip}:{self.rcv_port}")
-        """Starts the WebSocket server."""
-        async with websockets.serve(self.process_websocket, host=self.rcv_ip, port=self.rcv_port, ping_timeout=float("inf")) as server:
-            try:
-                socket = server.sockets[0]
-                self.rcv_port = (socket.getsockname()[1])
-                self.rcv_port_evt.set()
-                self.logger.info(f"Started WebSocket server on {self.rcv_ip}:{self.rcv_port}")
+        except TimeoutError:
+            self.logger.debug(f"The charge current did not reach the desired {current}A within {timeout_s}s.")
+            latency.timeout("total")
+            return False
 
-                self.logger.info("Waiting if server disconnects")
-                await self.disconnected_evt.wait()
-                server.close()
-                await server.wait_closed()
+        finally:
+            current_reached.cancel()
 
-            except asyncio.CancelledError:
-                self.logger.info("Server loop cancelled. Closing WebSocket server.")
-                self.shutdown = True
-                server.close()
-                await server.wait_closed()
-                raise
+        return True
 
-            finally:
-                self.websocket = None
+    async def stop_charging(self, connectorId: int, timeout_s: float | None = None) -> bool:
+        connector = self.charger_state.connectors[connectorId-1]
+        if timeout_s is None:
+            timeout_s = self.command_timeout_s
 
-    async def udp_handshake_loop(self, ip_address, port):
-        """Broadcasts UDP handshake messages until connected."""
-        self.logger.info(f"Sending UDP broadcast handshake to {self.broadcast_ip}:{self.broadcast_port}.")
+        self.setpoints[connectorId-1].cancel()
+        charging_stopped = connector.wait_for(lambda conn: conn.chargeStatus.value is not None and not conn.is_charging())
+        latency = self.trace_command(connectorId, charging_stopped)
+        try:
+            async with asyncio.timeout(timeout_s):
+                self.logger.debug(f"Waiting for charger state intialization.")
+                await self.charger_state.ready.wait()
+
+                retries = 0
+                while True:
+                    self.logger.debug(f"Sending stop charging command.")
+                    res = await self.send_authorize_msg(connector.miniCurrent.value, "Stop", connectorId)
+                    self.logger.debug(res)
+                    try:
+                        await asyncio.wait_for(asyncio.shield(charging_stopped), timeout=self.command_retry_period_s)
+                        break
+                    except TimeoutError:
+                        retries += 1
+                        self.logger.debug(f"The charge status ({connector.chargeStatus}) does not match the desired. Tries: {retries}.")
+                        self.logger.debug(f"{connector:<31}")
 
-        send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        send_sock.bind(('0.0.0.0', 3050))  # bind local port 3050
-        send_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        except TimeoutError:
+            self.logger.debug(f"The charging did not stop within {timeout_s}s.")
+            latency.timeout("total")
+            return False
 
-        try:
-            while self.websocket is None:
+        finally:
+            charging_stopped.cancel()
 
-                msg = UDPHandShake(
-                            timeout_time_unix = time.time() + self.udp_handshake_timeout_s,
-                            chargeBoxSN = self.charge_box_serial,
-                            ip_address = ip_address,
-                            port = port
-                        )
+        return True
 
-                message = msg.encode().encode("ASCII")
-                self.logger.debug(f">>UDP {message}")
-                send_sock.sendto(message, (self.broadcast_ip, self.broadcast_port))
+    async def send_message(self, websocket, message):
+        self.traffic_logger.debug(">> %s", message)
+        if self.recorder is not None:
+            self.recorder.record("tx", self.charge_box_serial, message)
+        await websocket.send(message)
 
-                await asyncio.sleep(self.udp_handshake_timeout_s)
+    async def send_ack(self, websocket, uniqueId):
+        message = self.ack_template.fill(f"{int(uniqueId)}")
+        await self.send_message(websocket, message)
+        acks_sent.inc()
+
+    def is_connected(self):
+        return self.websocket is not None
+
+    def register_connection_cbk(self, f_cbk):
+        self.connection_cbks.append(f_cbk)
+
+    def attach(self, websocket):
+        """Binds a freshly connected charger websocket to this connection and starts its handshake loop."""
+        self.websocket = websocket
+        remote_ip, remote_port = websocket.remote_address
+        self.logger.info(f"Connection established with SN{self.charge_box_serial} at {remote_ip}:{remote_port}!")
+        charger_connections.inc()
+        if self.disconnected_time is not None:
+            charger_downtime.observe(time.monotonic() - self.disconnected_time)
+        self.handshake_loop_task = asyncio.create_task(self.handshake_loop(websocket))
+        self.loop_tasks.add(self.handshake_loop_task)
+        self.handshake_loop_task.add_done_callback(self.loop_tasks.discard)
+        for cbk in self.connection_cbks:
+            cbk()
+
+    def detach(self, websocket):
+        if websocket is None or self.websocket is not websocket:
+            return
+        self.logger.info(f"Charger SN{self.charge_box_serial} disconnected.")
+        self.websocket = None
+        self.disconnected_time = time.monotonic()
+        # nothing will confirm the commands sent over the closed connection
+        self.pending_confirmations.resolve_all(False)
+        if self.handshake_loop_task is not None:
+            self.handshake_loop_task.cancel()
+            self.handshake_loop_task = None
+        for cbk in self.connection_cbks:
+            cbk()
+
+    async def process_message(self, websocket, msg_json):
+        """Handles a single decoded frame received from this charger."""
+        try:
+            # If it's an Ack message check if we're not expecting confirmation for a message
+            if msg_json["messageTypeId"] == Ack.messageTypeId:
+                frames_received.labels("Ack").inc()
+                # only the acks of commands carry a result
+                self.pending_confirmations.resolve(int(msg_json["uniqueId"]), msg_json["payload"].get("result", False))
+                return
 
-        except asyncio.CancelledError:
-            self.logger.info("UDP handshake loop cancelled.")
-            send_sock.close()
-            raise
+            # Otherwise it's a payload message, sned an ack for it and then process it
+            action = msg_json.get("action")
+            # one series per known action, the charger could send anything
+            frames_received.labels(action if action in PayloadMsg.action_registry else "unknown").inc()
+            uniqueId = int(msg_json["uniqueId"])
+            asyncio.create_task(self.send_ack(websocket, uniqueId))
+            msg_parsed = parse_json(msg_json)
+
+        except (KeyError, TypeError, ValueError) as e:
+            parse_failures.labels("payload").inc()
+            self.logger.warning(f"Ignoring a frame with an unexpected payload: {e!r}")
+            return
+
+        if msg_parsed is None:
+            parse_failures.labels("unknown_action").inc()
+            return
+        await self.charger_state.update(msg_parsed)
 
     async def handshake_loop(self, websocket):
         """Periodically sends WebSocket handshake to keep the connection alive."""
 
         try:
             while True:
-                msg = HandShake(
-                            current_time_unix = time.time(),
-                            userId = self.user_id,
-                            chargeBoxSN = self.charge_box_serial,
-                            connectionKey = self.connection_key
-                        )
-                message = msg.encode()
+                current_time_unix = time.time()
+                message = self.handshake_template.fill(f"{int(current_time_unix * 1000)}", HandShake.format_time(current_time_unix))
                 await self.send_message(websocket, message)
                 await asyncio.sleep(self.handshake_period_s)
 
         except asyncio.CancelledError:
             self.logger.info("Handshake loop cancelled.")
             raise
+
+        except websockets.exceptions.ConnectionClosed:
+            self.logger.info("Handshake loop stopped, websocket closed.")
     
     async def keyboard_loop(self):
-        # TODO: fix
-        while not self.charger_state.initialized():
-            await asyncio.sleep(1)
-        await asyncio.sleep(1.0)
+        await self.charger_state.ready.wait()
         self.logger.info("Detected charger state initialized, starting charging!")
 
         desired_current = 6
@@ -283,65 +349,210 @@ class SChargeConn:
         self.logger.info("Stopped charging!")
 
     async def main(self):
-        while not self.shutdown:
-            """Starts all tasks in the correct sequence."""
-            self.rcv_port_evt = asyncio.Event()
-            self.server_disconnected_evt = asyncio.Event()
-            self.server_loop_task = asyncio.create_task(self.server_loop())
-            self.loop_tasks.add(self.server_loop_task)
+        """Serves only this charger, see SChargeFleet for serving multiple chargers."""
+        fleet = SChargeFleet([self], rcv_ip=self.rcv_ip, rcv_port=self.rcv_port, logger=self.logger, recorder=self.recorder)
+        await fleet.main()
 
-            self.logger.info("Waiting for WebSocket server initialization.")
-            await self.rcv_port_evt.wait()
 
-            self.connected_ws_evt = asyncio.Event()
-            self.loop_tasks.add(asyncio.create_task(self.udp_handshake_loop(self.rcv_ip, self.rcv_port)))
+class SChargeFleet:
+    """A single WebSocket server shared by many chargers, frames are routed to the SChargeConn matching their serial number."""
 
-            self.logger.info("Waiting for charger to connect to WebSocket.")
-            await self.connected_ws_evt.wait()
+    def __init__(self, conns, rcv_ip, rcv_port, logger, recorder: ProtocolRecorder | None = None):
+        self.conns = {conn.charge_box_serial: conn for conn in conns}
+        self.logger = logger
 
-            self.handshake_loop_task = asyncio.create_task(self.handshake_loop(self.websocket))
-            self.loop_tasks.add(self.handshake_loop_task)
+        self.recorder = recorder
+        for conn in conns:
+            conn.recorder = recorder
+        self.traffic_logger = logger.getChild("traffic")
 
-        # self.loop_tasks.add(asyncio.create_task(self.keyboard_loop()))
+        self.rcv_ip = rcv_ip
+        self.rcv_port = rcv_port
 
-            await self.server_loop_task
-            if self.shutdown:
-                return
+        # get the 24 subnet corresponding to the specified ip address
+        ip_network = ipaddress.ip_network(rcv_ip).supernet(new_prefix=24)
+        self.broadcast_ip = f"{ip_network.broadcast_address}"
+        self.broadcast_port = 3050
+
+        self.udp_handshake_timeout_s = 1.9
+
+    @classmethod
+    def from_serials(cls, charge_box_serials, rcv_ip, rcv_port, logger, recorder: ProtocolRecorder | None = None, setpoint_min_interval_s: float = 2.0):
+        conns = [SChargeConn(serial, rcv_ip=rcv_ip, rcv_port=rcv_port, logger=logger, setpoint_min_interval_s=setpoint_min_interval_s) for serial in charge_box_serials]
+        return cls(conns, rcv_ip=rcv_ip, rcv_port=rcv_port, logger=logger, recorder=recorder)
 
-            for task in self.loop_tasks:
-                task.cancel()
+    def num_pending_confirmations(self):
+        return sum(conn.num_pending_confirmations() for conn in self.conns.values())
+
+    def disconnected_conns(self):
+        return [conn for conn in self.conns.values() if not conn.is_connected()]
+
+    async def process_websocket(self, websocket):
+        """Handles messages from one connected charger, the charger is identified by the first frame it sends.
+
+        If only one charger is waiting for a connection, it is bound right away instead, so that it gets the server handshake
+        even if it waits for it before sending any data.
+        """
+        conn = None
+        # whether a frame confirmed which charger this is
+        identified = False
+        disconnected = self.disconnected_conns()
+        if len(disconnected) == 1:
+            conn = disconnected[0]
+            conn.attach(websocket)
+        try:
+            while True:
+                # receive the raw bytes, the JSON decoder doesn't need them decoded to str first
+                message = await websocket.recv(decode=False)
+                # the time spent waiting for the next frame is not included
+                with profiler.timed("process_websocket"):
+                    self.traffic_logger.debug("<< %s", message)
+                    if self.recorder is not None:
+                        self.recorder.record("rx", conn.charge_box_serial if conn is not None else None, message)
+                    try:
+                        msg_json = json_codec.loads(message)
+                        msg_serial = msg_json["payload"]["chargeBoxSN"]
+                        if not isinstance(msg_serial, str):
+                            raise TypeError(f"chargeBoxSN is a {type(msg_serial).__name__}")
+                    except (ValueError, KeyError, TypeError) as e:
+                        parse_failures.labels("decode").inc()
+                        self.logger.warning(f"Ignoring a malformed frame {message!r}: {e!r}")
+                        continue
+                    if conn is not None and not identified and msg_serial != conn.charge_box_serial:
+                        # bound on connect to the only charger waiting for a connection, but another one reconnected
+                        conn.detach(websocket)
+                        conn = None
+                    identified = True
+                    if conn is None:
+                        conn = self.conns.get(msg_serial)
+                        if conn is None:
+                            self.logger.info(f"Ignoring message from an unknown charge box with SN{msg_serial}.")
+                            continue
+                        if conn.is_connected():
+                            self.logger.warning(f"Charger SN{msg_serial} reconnected, dropping its previous connection.")
+                            # closing lets the handler of the old websocket detach it first
+                            old_websocket = conn.websocket
+                            await old_websocket.close()
+                            conn.detach(old_websocket)
+                        conn.attach(websocket)
+
+                    elif msg_serial != conn.charge_box_serial:
+                        self.logger.info(f"Ignoring message for a different charge box with SN{msg_serial} (expected SN{conn.charge_box_serial}).")
+                        continue
+
+                    await conn.process_message(websocket, msg_json)
+
+        except websockets.exceptions.ConnectionClosedOK:
+            pass
+
+        except (websockets.exceptions.ConnectionClosedError, ConnectionResetError) as e:
+            self.logger.info(f"Websocket connection closed: {e}")
+
+        finally:
+            if conn is not None:
+                conn.detach(websocket)
+
+    async def udp_handshake_loop(self):
+        """Broadcasts UDP handshake messages for every charger that is not connected."""
+        self.logger.info(f"Sending UDP broadcast handshakes to {self.broadcast_ip}:{self.broadcast_port}.")
+
+        send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # allows running the charger simulator, which listens on port 3050, on the same machine
+        if hasattr(socket, "SO_REUSEPORT"):
+            send_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        send_sock.bind(('0.0.0.0', 3050))  # bind local port 3050
+        send_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        try:
+            while True:
+                for conn in self.disconnected_conns():
+                    msg = UDPHandShake(
+                                timeout_time_unix = time.time() + self.udp_handshake_timeout_s,
+                                chargeBoxSN = conn.charge_box_serial,
+                                ip_address = self.rcv_ip,
+                                port = self.rcv_port
+                            )
+
+                    message = msg.encode_bytes()
+                    self.traffic_logger.debug(">>UDP %s", message)
+                    send_sock.sendto(message, (self.broadcast_ip, self.broadcast_port))
+                    if self.recorder is not None:
+                        self.recorder.record("udp", conn.charge_box_serial, message)
+
+                await asyncio.sleep(self.udp_handshake_timeout_s)
+
+        except asyncio.CancelledError:
+            self.logger.info("UDP handshake loop cancelled.")
+            raise
+
+        finally:
+            send_sock.close()
+
+    async def main(self):
+        """Starts the WebSocket server and the UDP handshake loop and serves until cancelled."""
+        self.logger.info(f"Starting WebSocket server on {self.rcv_ip}:{self.rcv_port} for {len(self.conns)} charger(s).")
+        async with websockets.serve(self.process_websocket, host=self.rcv_ip, port=self.rcv_port, ping_timeout=float("inf")) as server:
+            socket = server.sockets[0]
+            self.rcv_port = (socket.getsockname()[1])
+            for conn in self.conns.values():
+                conn.rcv_port = self.rcv_port
+            self.logger.info(f"Started WebSocket server on {self.rcv_ip}:{self.rcv_port}")
+
+            udp_handshake_task = asyncio.create_task(self.udp_handshake_loop())
+            try:
+                await asyncio.Future()
+
+            except asyncio.CancelledError:
+                self.logger.info("Server loop cancelled. Closing WebSocket server.")
+                raise
+
+            finally:
+                udp_handshake_task.cancel()
+                for conn in self.conns.values():
+                    if conn.handshake_loop_task is not None:
+                        conn.handshake_loop_task.cancel()
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 4:
-        print("Please specify the charger serial number, this computer's IP address, and a serial port (\"auto\" to autoselect)!")
+        print("Please specify the charger serial number(s) (comma-separated for multiple chargers), this computer's IP address, and a serial port (\"auto\" to autoselect)!")
         exit(1)
 
-    logger = logging.getLogger("S-Charge_server")
-    logger.setLevel(logging.DEBUG)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    traffic_max_per_s = float(os.environ.get("SCHARGE_TRAFFIC_LOG_RATE", 50))
+    logger, log_listener = setup_logger("S-Charge_server", "/tmp/s-charge-server.log", traffic_max_per_s=traffic_max_per_s)
 
-    fh = logging.FileHandler("/tmp/s-charge-server.log")
-    fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
-
-    sh = logging.StreamHandler()
-    sh.setLevel(logging.INFO)
-    sh.setFormatter(formatter)
-    logger.addHandler(sh)
-
-    charge_box_serial = sys.argv[1]
+    charge_box_serials = sys.argv[1].split(",")
     rcv_ip = sys.argv[2]
     rcv_port = sys.argv[3]
     if rcv_port == "auto":
         rcv_port = None
-    s_charge_conn = SChargeConn(charge_box_serial, rcv_ip, rcv_port, logger=logger)
+    recorder = None
+    if os.environ.get("SCHARGE_CAPTURE_FILE"):
+        recorder = ProtocolRecorder(os.environ["SCHARGE_CAPTURE_FILE"])
+    setpoint_min_interval_s = float(os.environ.get("SCHARGE_SETPOINT_INTERVAL", 2.0))
+    s_charge_fleet = SChargeFleet.from_serials(charge_box_serials, rcv_ip, rcv_port, logger=logger, recorder=recorder, setpoint_min_interval_s=setpoint_min_interval_s)
+    telemetry_store = None
+    if os.environ.get("SCHARGE_TELEMETRY_DB"):
+        telemetry_store = TelemetryStore(os.environ["SCHARGE_TELEMETRY_DB"], logger=logger)
+        for conn in s_charge_fleet.conns.values():
+            session_tracker = SessionTracker(conn.charge_box_serial, logger=logger)
+            session_tracker.attach(conn.charger_state)
+            telemetry_store.attach(conn.charger_state, session_tracker)
+
+    async def run_tasks():
+        if telemetry_store is not None:
+            asyncio.create_task(telemetry_store.main())
+        # kill -USR1 <pid> switches the profiling on and off
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.toggle)
+        await s_charge_fleet.main()
     try:
-        asyncio.run(s_charge_conn.main())
+        asyncio.run(run_tasks())
     except KeyboardInterrupt:
         logger.info("Interrupted by user.")
 
-    for handler in logger.handlers:
-        handler.close()
-        logger.removeFilter(handler)
+    if recorder is not None:
+        recorder.close()
+    if telemetry_store is not None:
+        telemetry_store.close()
+
+    stop_logger(logger, log_listener)
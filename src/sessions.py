@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import collections
+import logging
+import time
+
+from charger_state import ChargerState, ChargerParam, ChargeStatusEnum
+
+
+class ChargingSession:
+    """Running aggregates of one charging session, updated in O(1) per sample."""
+
+    def __init__(self, connectorId: int, partial: bool):
+        self.connectorId = connectorId
+        # the session was already running when the server started
+        self.partial = partial
+        self.start = time.time()
+        self.start_monotonic = time.monotonic()
+        self.energy_kwh = 0.0
+        self.peak_current = 0.0
+        self.peak_power = 0.0
+        self.sum_current = 0.0
+        self.sum_power = 0.0
+        self.num_samples = 0
+
+    def sample(self, current: float, power: float, work: float | None):
+        self.peak_current = max(self.peak_current, current)
+        self.peak_power = max(self.peak_power, power)
+        self.sum_current += current
+        self.sum_power += power
+        self.num_samples += 1
+        # electricWork is the energy metered since the start of the session
+        if work is not None:
+            self.energy_kwh = work
+
+    def summary(self, chargeBoxSN: str, end_status: str):
+        num_samples = max(self.num_samples, 1)
+        return {
+                "sn": chargeBoxSN,
+                "connector": self.connectorId,
+                "start": round(self.start, 3),
+                "end": round(time.time(), 3),
+                "duration_s": round(time.monotonic() - self.start_monotonic, 1),
+                "energy_kwh": round(self.energy_kwh, 3),
+                "peak_current_a": round(self.peak_current, 2),
+                "avg_current_a": round(self.sum_current / num_samples, 2),
+                "peak_power_kw": round(self.peak_power, 3),
+                "avg_power_kw": round(self.sum_power / num_samples, 3),
+                "end_status": end_status,
+                "partial": self.partial,
+            }
+
+
+class SessionTracker:
+    """Tracks the charging sessions of each connector from the chargeStatus transitions.
+
+    A session starts when a connector switches to charging and ends when it switches to anything else,
+    the summary of every finished session is passed to the callbacks registered by register_session_cbk().
+    """
+
+    max_recent_sessions = 50
+
+    def __init__(self, chargeBoxSN: str, logger: logging.Logger | None = None):
+        self.chargeBoxSN = chargeBoxSN
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+        self.active = dict()
+        self.recent = collections.deque(maxlen=self.max_recent_sessions)
+        self.num_sessions = 0
+        self.total_energy_kwh = 0.0
+        self.total_duration_s = 0.0
+        self.session_cbks = []
+        self.connector_names = []
+
+    def attach(self, charger_state: ChargerState):
+        for connectorId, connector in enumerate(charger_state.connectors, start=1):
+            connector.chargeStatus.register_change_cbk(lambda param, previous, connectorId=connectorId: self.status_changed(connectorId, param, previous))
+            self.connector_names.append(connector.connectorName)
+        charger_state.register_sample_sink(self.record)
+
+    def register_session_cbk(self, f_cbk):
+        self.session_cbks.append(f_cbk)
+
+    def status_changed(self, connectorId: int, param: ChargerParam, previous):
+        session = self.active.get(connectorId)
+        if param.value == ChargeStatusEnum.CHARGING:
+            if session is None:
+                self.active[connectorId] = ChargingSession(connectorId, partial=previous is None)
+        elif session is not None:
+            del self.active[connectorId]
+            self.finish(session, param.value)
+
+    def finish(self, session: ChargingSession, end_status: str):
+        summary = session.summary(self.chargeBoxSN, str(end_status))
+        self.recent.append(summary)
+        self.num_sessions += 1
+        self.total_energy_kwh += summary["energy_kwh"]
+        self.total_duration_s += summary["duration_s"]
+        self.logger.info(f"Charging session on connector {session.connectorId} finished: {summary['energy_kwh']}kWh in {summary['duration_s']}s.")
+        for cbk in self.session_cbks:
+            cbk(summary)
+
+    def record(self, chargeBoxSN: str, t: float, samples):
+        if not self.active:
+            return
+        values = dict(samples)
+        for connectorId, session in self.active.items():
+            name = self.connector_names[connectorId - 1]
+            current = values.get(f"{name}/charge_current")
+            power = values.get(f"{name}/charge_power")
+            if current is not None and power is not None:
+                session.sample(current, power, values.get(f"{name}/charge_energy"))
+
+    def stats(self):
+        """Returns the aggregates over all the sessions finished since the start."""
+        return {
+                "sessions": self.num_sessions,
+                "energy_kwh": round(self.total_energy_kwh, 3),
+                "duration_s": round(self.total_duration_s, 1),
+                "active": len(self.active),
+            }
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import math
+import time
+from typing import Awaitable, Callable
+
+from metrics import Counter
+
+
+setpoints_dropped = Counter("scharge_setpoints_dropped", "Current setpoints replaced by a newer one before being sent.", ["sn", "connector"])
+
+
+class SetpointCoalescer:
+    """Sends the current setpoints of one connector, at most one Authorize per min_interval_s.
+
+    Only the latest submitted setpoint is kept, the intermediate ones are dropped, so the last one lands as soon as the interval allows.
+    A setpoint that is not acked is retried up to max_attempts times unless a newer one replaces it.
+    send() returns the success and the reason like SChargeConn.send_authorize_msg(), the reasons in terminal_reasons are not retried.
+    """
+    terminal_reasons = ("not charging",)
+
+    def __init__(self, charge_box_serial: str, connectorId: int, send: Callable[[int], Awaitable[tuple[bool, str]]], last_send_time: Callable[[], float], logger: logging.Logger, min_interval_s: float = 2.0, max_attempts: int = 3):
+        self.connectorId = connectorId
+        self.send = send
+        # monotonic time of the last Authorize sent to the connector by anything, not only by the coalescer
+        self.last_send_time = last_send_time
+        self.logger = logger
+        self.min_interval_s = min_interval_s
+        self.max_attempts = max_attempts
+
+        self.latest = None
+        self.attempts = 0
+        # the failed attempts may not have sent anything, the retries are spaced from the attempts too
+        self.last_attempt_time = -math.inf
+        self.applied = None
+        self.task = None
+        self.dropped = setpoints_dropped.labels(charge_box_serial, f"{connectorId}")
+
+    def submit(self, current: int):
+        if self.latest is not None:
+            self.dropped.inc()
+        self.latest = current
+        self.attempts = 0
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def cancel(self):
+        """Drops the queued setpoint and forgets the applied one, e.g. when a start or stop command takes over the connector."""
+        self.latest = None
+        self.applied = None
+        if self.task is not None:
+            self.task.cancel()
+            # a setpoint submitted before the cancelled task finishes needs a new task
+            self.task = None
+
+    async def run(self):
+        try:
+            while self.latest is not None:
+                delay = max(self.last_send_time(), self.last_attempt_time) + self.min_interval_s - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                current = self.latest
+                self.latest = None
+                if current == self.applied:
+                    continue
+                self.attempts += 1
+                self.last_attempt_time = time.monotonic()
+                success, reason = await self.send(current)
+                if success:
+                    self.applied = current
+                    self.logger.info(f"Charging current of connector {self.connectorId} set to {current}A.")
+                elif reason in self.terminal_reasons:
+                    self.logger.info(f"Not setting the charging current of connector {self.connectorId} to {current}A ({reason}).")
+                elif self.latest is None and self.attempts < self.max_attempts:
+                    self.logger.warning(f"Failed to set the charging current of connector {self.connectorId} to {current}A ({reason}), retrying.")
+                    self.latest = current
+                else:
+                    self.logger.error(f"Failed to set the charging current of connector {self.connectorId} to {current}A ({reason}).")
+        finally:
+            if self.task is asyncio.current_task():
+                self.task = None
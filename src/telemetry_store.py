@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import asyncio
+import concurrent.futures
+import json_codec
+import logging
+import sqlite3
+import sys
+import time
+
+from charger_state import ChargerState
+from sessions import SessionTracker
+
+
+class TelemetryStore:
+    """Stores the history of the numeric charger parameters in an SQLite database.
+
+    The samples are buffered in memory and written in one transaction every flush_period_s by a dedicated thread, so the event loop never waits for the disk.
+    The raw samples are downsampled to 1 minute and 15 minute statistics, each table only keeps the rows newer than its retention (None keeps them forever).
+    All timestamps are Unix times in seconds.
+    """
+
+    # (table, bucket length in seconds, source table)
+    aggregate_tables = [("samples_1m", 60, "samples_raw"), ("samples_15m", 900, "samples_1m")]
+
+    def __init__(self, path: str, logger: logging.Logger | None = None, flush_period_s: float = 5.0, downsample_period_s: float = 60.0,
+                 raw_retention_s: float | None = 2 * 86400, retention_1m_s: float | None = 30 * 86400, retention_15m_s: float | None = None):
+        self.path = path
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.flush_period_s = flush_period_s
+        self.downsample_period_s = downsample_period_s
+        self.retentions = {"samples_raw": raw_retention_s, "samples_1m": retention_1m_s, "samples_15m": retention_15m_s}
+
+        # rows waiting for the next flush
+        self.buffer = []
+        self.session_buffer = []
+        self.num_written = 0
+        self.last_downsample_time = 0.0
+
+        # SQLite connections can only be used from the thread that created them
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="TelemetryStore")
+        self.db = None
+        self.executor.submit(self.open).result()
+
+    def open(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS samples_raw (sn TEXT NOT NULL, param TEXT NOT NULL, t REAL NOT NULL, value REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS samples_raw_idx ON samples_raw (sn, param, t)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS samples_raw_t_idx ON samples_raw (t)")
+            for table, _, _ in self.aggregate_tables:
+                self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (sn TEXT NOT NULL, param TEXT NOT NULL, t REAL NOT NULL, count INTEGER, min REAL, max REAL, mean REAL, PRIMARY KEY (sn, param, t))")
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_t_idx ON {table} (t)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS sessions (sn TEXT NOT NULL, connector INTEGER NOT NULL, start REAL NOT NULL, end REAL NOT NULL, summary TEXT NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS sessions_idx ON sessions (sn, start)")
+            # the end of the last downsampled bucket of each aggregate table
+            self.db.execute("CREATE TABLE IF NOT EXISTS downsampled (tbl TEXT PRIMARY KEY, t REAL NOT NULL)")
+
+    def record(self, chargeBoxSN: str, t: float, samples):
+        """Buffers the (param, value) samples taken at time t, called from the event loop."""
+        for param, value in samples:
+            self.buffer.append((chargeBoxSN, param, t, value))
+
+    def record_session(self, summary: dict):
+        """Buffers the summary of a finished charging session, see SessionTracker."""
+        self.session_buffer.append((summary["sn"], summary["connector"], summary["start"], summary["end"], json_codec.dumps(summary)))
+
+    def attach(self, charger_state: ChargerState, session_tracker: SessionTracker | None = None):
+        charger_state.register_sample_sink(self.record)
+        if session_tracker is not None:
+            session_tracker.register_session_cbk(self.record_session)
+
+    def write(self, rows, session_rows):
+        with self.db:
+            self.db.executemany("INSERT INTO samples_raw (sn, param, t, value) VALUES (?, ?, ?, ?)", rows)
+            self.db.executemany("INSERT INTO sessions (sn, connector, start, end, summary) VALUES (?, ?, ?, ?, ?)", session_rows)
+        self.num_written += len(rows)
+
+    def downsample(self, now: float):
+        """Aggregates the completed buckets into the coarser tables and deletes the rows older than the retentions."""
+        with self.db:
+            for table, bucket_s, source in self.aggregate_tables:
+                row = self.db.execute("SELECT t FROM downsampled WHERE tbl = ?", (table,)).fetchone()
+                if row is not None:
+                    t_from = row[0]
+                else:
+                    row = self.db.execute(f"SELECT MIN(t) FROM {source}").fetchone()
+                    if row[0] is None:
+                        continue
+                    t_from = row[0] // bucket_s * bucket_s
+                t_to = now // bucket_s * bucket_s
+                if t_to <= t_from:
+                    continue
+
+                if source == "samples_raw":
+                    aggregates = "COUNT(value), MIN(value), MAX(value), AVG(value)"
+                else:
+                    aggregates = "SUM(count), MIN(min), MAX(max), SUM(mean * count) / SUM(count)"
+                self.db.execute(f"INSERT OR REPLACE INTO {table} (sn, param, t, count, min, max, mean) "
+                                f"SELECT sn, param, CAST(t / {bucket_s} AS INTEGER) * {bucket_s} AS bucket, {aggregates} "
+                                f"FROM {source} WHERE t >= ? AND t < ? GROUP BY sn, param, bucket",
+                                (t_from, t_to))
+                self.db.execute("INSERT OR REPLACE INTO downsampled (tbl, t) VALUES (?, ?)", (table, t_to))
+
+            for table, retention_s in self.retentions.items():
+                if retention_s is not None:
+                    self.db.execute(f"DELETE FROM {table} WHERE t < ?", (now - retention_s,))
+
+    def range(self, chargeBoxSN: str, param: str, t_from: float, t_to: float, resolution: str = "raw"):
+        table = f"samples_{resolution}"
+        if table not in self.retentions:
+            raise ValueError(f"Unknown resolution {resolution}, use one of raw, 1m, 15m!")
+        columns = "t, value" if resolution == "raw" else "t, count, min, max, mean"
+        return self.db.execute(f"SELECT {columns} FROM {table} WHERE sn = ? AND param = ? AND t >= ? AND t < ? ORDER BY t",
+                               (chargeBoxSN, param, t_from, t_to)).fetchall()
+
+    def session_range(self, chargeBoxSN: str, t_from: float, t_to: float):
+        rows = self.db.execute("SELECT summary FROM sessions WHERE sn = ? AND start >= ? AND start < ? ORDER BY start", (chargeBoxSN, t_from, t_to)).fetchall()
+        return [json_codec.loads(row[0]) for row in rows]
+
+    async def query_sessions(self, chargeBoxSN: str, t_from: float, t_to: float | None = None):
+        """Returns the summaries of the charging sessions started between t_from and t_to."""
+        if t_to is None:
+            t_to = time.time()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.session_range, chargeBoxSN, t_from, t_to)
+
+    async def query(self, chargeBoxSN: str, param: str, t_from: float, t_to: float | None = None, resolution: str = "raw"):
+        """Returns the (t, value) rows, or the (t, count, min, max, mean) rows for the "1m" and "15m" resolutions, of a parameter between t_from and t_to."""
+        if t_to is None:
+            t_to = time.time()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.range, chargeBoxSN, param, t_from, t_to, resolution)
+
+    async def flush(self):
+        now = time.time()
+        rows = self.buffer
+        self.buffer = []
+        session_rows = self.session_buffer
+        self.session_buffer = []
+        loop = asyncio.get_running_loop()
+        if rows or session_rows:
+            await loop.run_in_executor(self.executor, self.write, rows, session_rows)
+        if now - self.last_downsample_time > self.downsample_period_s:
+            self.last_downsample_time = now
+            await loop.run_in_executor(self.executor, self.downsample, now)
+
+    async def main(self):
+        while True:
+            await asyncio.sleep(self.flush_period_s)
+            try:
+                await self.flush()
+            except sqlite3.Error as e:
+                self.logger.error(f"Failed to write the telemetry to {self.path}: {e}")
+
+    def close(self):
+        """Writes the buffered samples and closes the database, call it after the event loop stopped."""
+        rows = self.buffer
+        self.buffer = []
+        session_rows = self.session_buffer
+        self.session_buffer = []
+
+        def close_db():
+            if rows or session_rows:
+                self.write(rows, session_rows)
+            self.db.close()
+        self.executor.submit(close_db).result()
+        self.executor.shutdown()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Please specify the telemetry database, the charger serial number, the parameter (or \"sessions\") and optionally the time span in hours and the resolution (raw, 1m or 15m)!")
+        print("example:")
+        print("python3 telemetry_store.py /tmp/scharge-telemetry.db XXXXYYYYZZZZ connectorMain/charge_power 24 1m")
+        exit(1)
+
+    db_path, charge_box_serial, param = sys.argv[1:4]
+    span_h = float(sys.argv[4]) if len(sys.argv) > 4 else 1.0
+    resolution = sys.argv[5] if len(sys.argv) > 5 else "raw"
+
+    store = TelemetryStore(db_path)
+    now = time.time()
+    if param == "sessions":
+        for summary in store.executor.submit(store.session_range, charge_box_serial, now - span_h * 3600, now).result():
+            print(json_codec.dumps(summary))
+    else:
+        for row in store.executor.submit(store.range, charge_box_serial, param, now - span_h * 3600, now, resolution).result():
+            print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[0])), *row[1:], sep="\t")
+    store.close()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import math
+import time
+from array import array
+from typing import NamedTuple
+
+
+class WindowStats(NamedTuple):
+    count: int
+    min: float
+    max: float
+    mean: float
+
+
+class TimeSeries:
+    """Fixed-capacity ring buffer of (monotonic timestamp, value) samples, the oldest samples are overwritten once full.
+
+    The values are kept in the leaves of segment trees of their sums, minima and maxima,
+    so that the statistics over any time window take O(log n) time.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError(f"The capacity must be positive, got {capacity}!")
+        self.capacity = capacity
+        # number of the tree leaves, the tree of n leaves is stored in an array of 2n nodes with the root at index 1
+        self.num_leaves = 1 << (capacity - 1).bit_length()
+        self.times = array("d", [0.0]) * capacity
+        self.sums = array("d", [0.0]) * (2 * self.num_leaves)
+        self.mins = array("d", [math.inf]) * (2 * self.num_leaves)
+        self.maxs = array("d", [-math.inf]) * (2 * self.num_leaves)
+        # ring position of the next sample and the number of stored samples
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t: float, value: float):
+        """Stores a sample, the timestamps must not decrease."""
+        pos = self.head
+        self.times[pos] = t
+        sums, mins, maxs = self.sums, self.mins, self.maxs
+        it = pos + self.num_leaves
+        sums[it] = mins[it] = maxs[it] = value
+        it >>= 1
+        while it:
+            left = 2 * it
+            right = left + 1
+            sums[it] = sums[left] + sums[right]
+            mins[it] = min(mins[left], mins[right])
+            maxs[it] = max(maxs[left], maxs[right])
+            it >>= 1
+
+        self.head = pos + 1 if pos + 1 < self.capacity else 0
+        if self.count < self.capacity:
+            self.count += 1
+
+    def position(self, k: int) -> int:
+        """Returns the ring position of the k-th oldest sample."""
+        return (self.head - self.count + k) % self.capacity
+
+    def first_since(self, t_from: float) -> int:
+        """Returns the age rank of the oldest sample with a timestamp of at least t_from (count if there is none)."""
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[self.position(mid)] < t_from:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, lo: int, hi: int):
+        """Returns the sum, minimum and maximum of the values at the ring positions lo to hi - 1."""
+        total = 0.0
+        low = math.inf
+        high = -math.inf
+        lo += self.num_leaves
+        hi += self.num_leaves
+        while lo < hi:
+            if lo & 1:
+                total += self.sums[lo]
+                low = min(low, self.mins[lo])
+                high = max(high, self.maxs[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                total += self.sums[hi]
+                low = min(low, self.mins[hi])
+                high = max(high, self.maxs[hi])
+            lo >>= 1
+            hi >>= 1
+        return total, low, high
+
+    def window_stats(self, window_s: float, now: float | None = None) -> WindowStats | None:
+        """Returns the statistics of the samples from the last window_s seconds before now, None if there are none."""
+        if now is None:
+            now = time.monotonic()
+        first = self.first_since(now - window_s)
+        num = self.count - first
+        if num == 0:
+            return None
+
+        start = self.position(first)
+        end = start + num
+        if end <= self.capacity:
+            total, low, high = self.query(start, end)
+        else:
+            # the window wraps around the end of the ring
+            total, low, high = self.query(start, self.capacity)
+            total_wrapped, low_wrapped, high_wrapped = self.query(0, end - self.capacity)
+            total += total_wrapped
+            low = min(low, low_wrapped)
+            high = max(high, high_wrapped)
+        return WindowStats(num, low, high, total / num)
+
+    def recent(self, window_s: float, now: float | None = None) -> list[tuple[float, float]]:
+        """Returns the (timestamp, value) samples from the last window_s seconds before now, oldest first."""
+        if now is None:
+            now = time.monotonic()
+        ret = []
+        for k in range(self.first_since(now - window_s), self.count):
+            pos = self.position(k)
+            ret.append((self.times[pos], self.sums[pos + self.num_leaves]))
+        return ret
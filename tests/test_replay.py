@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import sys
+
+# the sources are flat scripts importing each other by module name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from protocol_recorder import ProtocolRecorder
+from replay import replay
+
+
+SYNCHRO_DATA = '{"messageTypeId":"5","uniqueId":"3720","action":"SynchroData","payload":{"chargeBoxSN":"X","connectorMain":{"voltage":"405.92","current":"0.00","power":"0.00","electricWork":"0.00","chargingTime":"0:0:0"},"connectorVice":{"voltage":"406.63","current":"0.00","power":"0.00","electricWork":"0.00","chargingTime":"0:0:0"},"meterInfo":{"voltage":"0.00","current":"0.00","power":"0.00"}}}'
+NWIRE_TO_DICS = '{"messageTypeId":"5","uniqueId":"3721","action":"NWireToDics","payload":{"chargeBoxSN":"X","NWireExist":true,"NWireClosed":false}}'
+
+
+def test_replay_skips_malformed_frames(tmp_path):
+    path = str(tmp_path / "capture.jsonl")
+    recorder = ProtocolRecorder(path)
+    recorder.record("rx", "X", SYNCHRO_DATA)
+    # not JSON, missing the action and a non-string serial number
+    recorder.record("rx", "X", '{"messageTypeId":"5","uniqueId"')
+    recorder.record("rx", "X", '{"messageTypeId":"5","uniqueId":"1","payload":{"chargeBoxSN":"X"}}')
+    recorder.record("rx", "X", '{"messageTypeId":"5","uniqueId":"2","action":"NWireToDics","payload":{"chargeBoxSN":["X"],"NWireExist":true,"NWireClosed":false}}')
+    recorder.record("rx", "X", NWIRE_TO_DICS)
+    recorder.close()
+
+    stats = asyncio.run(replay(path))
+    assert stats["frames"] == 5
+    assert stats["parsed"] == 2
+    assert stats["chargers"] == 1